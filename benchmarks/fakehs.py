@@ -0,0 +1,156 @@
+import json
+import re
+import time
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from itertools import count
+from threading import Lock, Thread
+from urllib.parse import urlsplit, unquote
+
+
+class FakeHomeserver:
+    """
+    Stand-in for the client-server API endpoints the bot uses, which answers every call
+    after a configurable latency and counts calls per endpoint template.
+    Room membership is whatever the benchmark says it is, through join() and leave().
+    """
+    def __init__(self, bot, latency=0):
+        self.bot = bot
+        self.latency = latency
+        self.lock = Lock()
+        self.calls = Counter()
+        # Room ID -> set of joined users
+        self.members = {}
+        # User ID -> {field: value}
+        self.profiles = {}
+        # Access token -> user ID
+        self.tokens = {}
+        self._event_ids = count()
+        self._room_ids = count()
+        self._server = None
+
+    def join(self, room_id, mxid):
+        with self.lock:
+            self.members.setdefault(room_id, set()).add(mxid)
+
+    def leave(self, room_id, mxid):
+        with self.lock:
+            self.members.get(room_id, set()).discard(mxid)
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def new_event_id(self):
+        return f'$fake{next(self._event_ids)}'
+
+    def start(self, host, port):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Otherwise, each response would wait on the client's delayed ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def handle_method(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                token = (self.headers.get('Authorization') or '')[len('Bearer '):]
+                status, reply = fake.handle(self.command, unquote(urlsplit(self.path).path), body, token)
+
+                data = json.dumps(reply).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_PUT = do_POST = handle_method
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+    def handle(self, method, path, body, token):
+        if self.latency:
+            time.sleep(self.latency)
+
+        path = path.replace('/_matrix/client/r0', '', 1)
+        template = re.sub(r'/(?:[!@$#][^/]*|\d+(?=/|$))', '/{id}', path)
+        with self.lock:
+            self.calls[f'{method} {template}'] += 1
+
+        m = re.fullmatch(r'/rooms/([^/]+)/(\w+)(?:/(.*))?', path)
+        if m:
+            return self.handle_room(method, *m.groups(), body)
+
+        m = re.fullmatch(r'/profile/([^/]+)/(\w+)', path)
+        if m:
+            mxid, field = m.groups()
+            with self.lock:
+                if method == 'PUT':
+                    self.profiles.setdefault(mxid, {}).update(body)
+                    return 200, {}
+                profile = self.profiles.get(mxid)
+            if profile == None and mxid != self.bot:
+                profile = {'displayname': mxid[1:].split(':')[0]}
+            if profile == None or field not in profile:
+                return 404, {'errcode': 'M_NOT_FOUND'}
+            return 200, {field: profile[field]}
+
+        if path == '/createRoom':
+            room_id = f'!created{next(self._room_ids)}:localhost'
+            self.join(room_id, self.bot)
+            return 200, {'room_id': room_id}
+        if path == '/account/whoami':
+            with self.lock:
+                mxid = self.tokens.get(token)
+            if mxid == None:
+                return 401, {'errcode': 'M_UNKNOWN_TOKEN'}
+            return 200, {'user_id': mxid}
+        if path == '/joined_rooms':
+            with self.lock:
+                return 200, {'joined_rooms': [room_id for room_id, members in self.members.items() if self.bot in members]}
+        if path == '/register':
+            with self.lock:
+                self.profiles[self.bot] = {'displayname': body['username']}
+            return 200, {'user_id': self.bot}
+        if path.startswith('/presence/'):
+            return 200, {}
+        if path.startswith('/directory/room/'):
+            return 404, {'errcode': 'M_NOT_FOUND'}
+        return 404, {'errcode': 'M_UNRECOGNIZED'}
+
+    def handle_room(self, method, room_id, action, rest, body):
+        with self.lock:
+            members = set(self.members.get(room_id, ()))
+
+        if action == 'joined_members':
+            if self.bot not in members:
+                return 403, {'errcode': 'M_FORBIDDEN'}
+            return 200, {'joined': {mxid: {} for mxid in members}}
+        if action == 'members':
+            return 200, {'chunk': [{'state_key': mxid, 'content': {'membership': 'join'}} for mxid in members]}
+        if action in ('send', 'redact'):
+            return 200, {'event_id': self.new_event_id()}
+        if action == 'state':
+            if method == 'PUT':
+                return 200, {'event_id': self.new_event_id()}
+            return 404, {'errcode': 'M_NOT_FOUND'}
+        if action == 'receipt':
+            return 200, {}
+        if action == 'join':
+            self.join(room_id, self.bot)
+            return 200, {'room_id': room_id}
+        if action == 'leave':
+            self.leave(room_id, self.bot)
+            return 200, {}
+        return 404, {'errcode': 'M_UNRECOGNIZED'}
@@ -0,0 +1,307 @@
+"""
+End-to-end throughput benchmark: runs the appservice against a stand-in homeserver,
+and pushes it synthetic transactions of message bursts, membership churn and control commands.
+
+Run from the repository root, with the same arguments to compare runs:
+    python -m benchmarks.run [--rooms N] [--users M] [--latency MS] [--db-dsn DSN] [-- <appservice arguments>]
+"""
+import argparse
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+import yaml
+
+from .fakehs import FakeHomeserver
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DOMAIN = 'localhost'
+BOT = f'@_imposter_bot:{DOMAIN}'
+
+
+class Workload:
+    """
+    Builds transactions of events the way the homeserver would send them,
+    keeping the fake homeserver's idea of room membership in step.
+    """
+    def __init__(self, hs, rooms, users, guests):
+        self.hs = hs
+        self.rooms = [f'!room{i}:{DOMAIN}' for i in range(rooms)]
+        self.users = [f'@user{i}:{DOMAIN}' for i in range(users)]
+        self.guests = [f'@guest{i}:{DOMAIN}' for i in range(guests)]
+        self.control_rooms = {user: f'!dm{i}:{DOMAIN}' for i, user in enumerate(self.users)}
+        self.owners = {room_id: self.users[i % len(self.users)] for i, room_id in enumerate(self.rooms)}
+        self._event_num = 0
+
+    def event(self, type, room_id, sender, content, state_key=None):
+        self._event_num += 1
+        event = {
+            'type': type,
+            'room_id': room_id,
+            'sender': sender,
+            'content': content,
+            'event_id': f'$bench{self._event_num}',
+            'origin_server_ts': int(time.time() * 1000)
+        }
+        if state_key != None:
+            event['state_key'] = state_key
+        return event
+
+    def member(self, room_id, mxid, membership, sender=None, **content):
+        if membership == 'join':
+            self.hs.join(room_id, mxid)
+        elif membership == 'leave':
+            self.hs.leave(room_id, mxid)
+        return self.event('m.room.member', room_id, sender or mxid, dict(content, membership=membership), mxid)
+
+    def message(self, room_id, sender, body):
+        return self.event('m.room.message', room_id, sender, {'msgtype': 'm.text', 'body': body})
+
+    def command(self, user, text):
+        return self.message(self.control_rooms[user], user, text)
+
+
+    def setup(self):
+        # Every user gets a control room with a token, and mimics in the rooms they own
+        for user, control_room in self.control_rooms.items():
+            self.hs.join(control_room, user)
+            self.hs.tokens[f'token_{user}'] = user
+            yield [self.member(control_room, BOT, 'invite', user, is_direct=True)]
+            yield [self.member(control_room, BOT, 'join')]
+            yield [self.command(user, f'token token_{user}')]
+
+        for room_id in self.rooms:
+            owner = self.owners[room_id]
+            self.hs.join(room_id, owner)
+            yield [self.member(room_id, BOT, 'invite', owner)]
+            yield [self.member(room_id, BOT, 'join')]
+            yield [self.member(room_id, mxid, 'join') for mxid in self.users + self.guests if mxid != owner]
+            yield [self.command(owner, f'mimicme {room_id}')]
+
+    def messages(self, count, batch):
+        events = []
+        for i in range(count):
+            room_id = self.rooms[i % len(self.rooms)]
+            senders = [mxid for mxid in self.users + self.guests if mxid != self.owners[room_id]]
+            events.append(self.message(room_id, random.choice(senders), f'message {i}'))
+            if len(events) == batch:
+                yield events
+                events = []
+        if len(events) != 0:
+            yield events
+
+    def churn(self, count):
+        # Listening users and guests leave a room and come back
+        for i in range(count):
+            room_id = self.rooms[i % len(self.rooms)]
+            mxid = random.choice([mxid for mxid in self.users + self.guests if mxid != self.owners[room_id]])
+            yield [self.member(room_id, mxid, 'leave')]
+            yield [self.member(room_id, mxid, 'join')]
+
+    def commands(self, count):
+        texts = ['status', 'actions', 'setmode replace', 'setmode echo', 'blacklist @nobody:.+', 'getblacklist', 'help']
+        for i in range(count):
+            user = self.users[i % len(self.users)]
+            yield [self.command(user, texts[i % len(texts)])]
+
+
+class PostgresSchema:
+    """
+    A schema of its own for one run, in a PostgreSQL database that may hold other things,
+    which is dropped along with everything in it once the run is over.
+    """
+    def __init__(self, dsn):
+        import psycopg2
+        from psycopg2.extensions import make_dsn
+        self.name = f'imposter_bench_{os.getpid()}'
+        self._conn = psycopg2.connect(dsn)
+        self._conn.autocommit = True
+        self._conn.cursor().execute(f'CREATE SCHEMA {self.name}')
+        self.dsn = make_dsn(dsn, options=f'-c search_path={self.name}')
+
+    def drop(self):
+        self._conn.cursor().execute(f'DROP SCHEMA {self.name} CASCADE')
+        self._conn.close()
+
+
+class Appservice:
+    def __init__(self, work_dir, hs_port, as_port, args, db_dsn=None):
+        self.url = f'http://127.0.0.1:{as_port}'
+        self.work_dir = work_dir
+        self.session = requests.Session()
+        self._txnId = 0
+
+        with open(os.path.join(REPO_DIR, 'example-registration.yaml')) as f:
+            registration = yaml.safe_load(f)
+        self.hs_token = registration['hs_token']
+        shutil.copy(os.path.join(REPO_DIR, 'example-registration.yaml'), os.path.join(work_dir, 'registration.yaml'))
+
+        appservice = {'https': False, 'host': '127.0.0.1', 'port': as_port, 'db_name': 'imposter.db'}
+        if db_dsn != None:
+            appservice.update(db_engine='postgres', db_dsn=db_dsn)
+
+        with open(os.path.join(work_dir, 'config.yaml'), 'w') as f:
+            yaml.safe_dump({
+                'homeserver': {'address': f'http://127.0.0.1:{hs_port}', 'domain': DOMAIN},
+                'appservice': appservice,
+                'bot': {'displayname': 'ImposterBot', 'avatar': ''},
+                # The stand-in homeserver doesn't rate-limit
+                'ratelimit': {'rate': None},
+                'logging': {'level': 'warning'}
+            }, f)
+
+        self.log = open(os.path.join(work_dir, 'appservice.log'), 'w')
+        self.proc = subprocess.Popen(
+            [sys.executable, '-m', 'matrix_imposter_bot', *args],
+            cwd=work_dir, stdout=self.log, stderr=subprocess.STDOUT,
+            env=dict(os.environ, PYTHONPATH=REPO_DIR))
+
+    def wait_ready(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() != None:
+                raise RuntimeError(f'Appservice exited; see {self.log.name}')
+            try:
+                self.session.get(f'{self.url}/metrics', timeout=1)
+                return
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        raise RuntimeError('Appservice did not start in time')
+
+    def put(self, events, attempts):
+        # Returns the latency of the transaction, retrying it like the homeserver would,
+        # or None if it still failed after that many attempts
+        txnId = self._txnId
+        self._txnId += 1
+        start = time.monotonic()
+        for attempt in range(attempts):
+            try:
+                r = self.session.put(f'{self.url}/transactions/{txnId}',
+                    params={'access_token': self.hs_token}, json={'events': events}, timeout=60)
+                if r.status_code == 200:
+                    return time.monotonic() - start
+            except requests.RequestException:
+                pass
+            if attempt + 1 < attempts:
+                time.sleep(0.1)
+        return None
+
+    def stop(self):
+        self.proc.send_signal(signal.SIGINT)
+        try:
+            self.proc.wait(10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+        self.log.close()
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def run_phase(appservice, hs, name, transactions, attempts):
+    latencies = []
+    failed = 0
+    events = 0
+    calls_before = hs.total_calls()
+    start = time.monotonic()
+    for txn in transactions:
+        latency = appservice.put(txn, attempts)
+        if latency != None:
+            latencies.append(latency)
+        else:
+            failed += 1
+        events += len(txn)
+    elapsed = time.monotonic() - start
+
+    return {
+        'phase': name,
+        'events': events,
+        'txns': len(latencies) + failed,
+        'failed txns': failed,
+        'seconds': elapsed,
+        'events/s': events / elapsed,
+        'p50 ms': percentile(latencies, 50) * 1000,
+        'p99 ms': percentile(latencies, 99) * 1000,
+        'hs calls/event': (hs.total_calls() - calls_before) / events
+    }
+
+def format_report(args, results, hs):
+    columns = ['phase', 'events', 'txns', 'failed txns', 'seconds', 'events/s', 'p50 ms', 'p99 ms', 'hs calls/event']
+    lines = [
+        f'rooms={args.rooms} users={args.users} guests={args.guests} latency={args.latency}ms '
+        f'messages={args.messages} batch={args.batch} churn={args.churn} commands={args.commands} '
+        f'db={"postgres" if args.db_dsn != None else "sqlite"} appservice args={args.appservice_args}',
+        ' '.join(f'{column:>14}' for column in columns)
+    ]
+    for result in results:
+        lines.append(' '.join(
+            f'{result[column]:>14.2f}' if isinstance(result[column], float) else f'{result[column]:>14}'
+            for column in columns))
+
+    lines.append('homeserver calls:')
+    for endpoint, calls in hs.calls.most_common():
+        lines.append(f'{calls:>8} {endpoint}')
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end throughput benchmark of the appservice.')
+    parser.add_argument('--rooms', type=int, default=10, help='monitored rooms')
+    parser.add_argument('--users', type=int, default=5, help='listening users, who are in every room')
+    parser.add_argument('--guests', type=int, default=5, help='non-listening users, who are in every room')
+    parser.add_argument('--messages', type=int, default=1000, help='messages in the message burst phase')
+    parser.add_argument('--batch', type=int, default=10, help='events per transaction of the message burst phase')
+    parser.add_argument('--churn', type=int, default=100, help='leave & rejoin pairs in the membership churn phase')
+    parser.add_argument('--commands', type=int, default=100, help='commands in the control command phase')
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds the homeserver takes per call')
+    parser.add_argument('--attempts', type=int, default=10, help='times to send a transaction before counting it as failed')
+    parser.add_argument('--hs-port', type=int, default=18008)
+    parser.add_argument('--as-port', type=int, default=18009)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db-dsn', default=os.environ.get('IMPOSTER_BENCH_DB_DSN'),
+        help='PostgreSQL database to run against instead of SQLite, in a new schema that is dropped afterwards '
+            '(default: $IMPOSTER_BENCH_DB_DSN)')
+    parser.add_argument('--output', default='bench_output.txt', help='file to append the report to')
+    parser.add_argument('appservice_args', nargs='*', help='arguments for the appservice, like -a')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    hs = FakeHomeserver(BOT, args.latency / 1000)
+    hs.start('127.0.0.1', args.hs_port)
+    work_dir = tempfile.mkdtemp(prefix='imposter-bench-')
+    db_schema = PostgresSchema(args.db_dsn) if args.db_dsn != None else None
+    appservice = Appservice(work_dir, args.hs_port, args.as_port, args.appservice_args,
+        db_schema.dsn if db_schema != None else None)
+    try:
+        appservice.wait_ready()
+        workload = Workload(hs, args.rooms, args.users, args.guests)
+        results = [
+            run_phase(appservice, hs, 'setup', workload.setup(), args.attempts),
+            run_phase(appservice, hs, 'messages', workload.messages(args.messages, args.batch), args.attempts),
+            run_phase(appservice, hs, 'churn', workload.churn(args.churn), args.attempts),
+            run_phase(appservice, hs, 'commands', workload.commands(args.commands), args.attempts)
+        ]
+    finally:
+        appservice.stop()
+        hs.stop()
+        if db_schema != None:
+            db_schema.drop()
+
+    report = format_report(args, results, hs)
+    print(report)
+    with open(args.output, 'a') as f:
+        f.write(report + '\n')
+    shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
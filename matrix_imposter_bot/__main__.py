@@ -2,11 +2,13 @@ import sys
 
 from . import app
 from . import config
+from . import log
 
 
 dev = False
 debug = False
 skip_prep = False
+use_async = False
 
 for arg in sys.argv[1:]:
     if arg == '-d':
@@ -15,6 +17,8 @@ for arg in sys.argv[1:]:
         debug = True
     elif arg == '--skip':
         skip_prep = True
+    elif arg == '-a':
+        use_async = True
     else:
         print(f'Invalid argument: {arg}')
         sys.exit(-1)
@@ -22,16 +26,25 @@ for arg in sys.argv[1:]:
 if debug:
     dev = True
 
+log.setup()
+
 if not skip_prep:
     from .meta import prep
     prep()
     sys.argv.append('--skip')
+else:
+    # Still need the jobs that work off of handled transactions
+    from .meta import start_scheduler
+    start_scheduler(presence=False)
 
 
 host=config.cfg_settings['appservice']['host']
 port=config.cfg_settings['appservice']['port']
 
-if not dev:
+if use_async:
+    from .aioserver import serve
+    serve(host, port)
+elif not dev:
     from waitress import serve
     res = serve(app, host=host, port=port)
 else:
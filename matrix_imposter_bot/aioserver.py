@@ -0,0 +1,225 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from time import monotonic
+
+from aiohttp import web, ClientError, ClientSession, ClientTimeout, TCPConnector
+from requests.exceptions import ConnectionError, Timeout
+
+from . import app
+from . import config
+from . import log
+from . import metrics
+from . import ratelimit
+from . import receipts
+from . import utils
+from . import workers
+from .apputils import display_names, store_display_name
+from .main import validate_hs_token, get_uncommitted_txn_events, handle_txn_events, ack_txn
+
+
+request_log = log.get('request')
+
+class AsyncHomeserver:
+    """
+    Async counterpart of apputils.mx_request, for homeserver calls that don't need a txnId.
+    Requests go through the same circuit breaker and rate limiting, but aren't retried,
+    since they're only made to get ahead of requests the bot logic would make anyway.
+    """
+    def __init__(self):
+        self._session = None
+
+    async def start(self):
+        self._session = ClientSession(
+            connector=TCPConnector(limit_per_host=config.hs_pool_size),
+            timeout=ClientTimeout(sock_connect=config.hs_connect_timeout, total=config.hs_timeout))
+
+    async def close(self):
+        await self._session.close()
+
+    async def request(self, method, endpoint, json=None, access_token=None):
+        # Raises like utils.make_request does: ConnectionError (or CircuitOpenError) or Timeout,
+        # or RateLimitedError if requests with the access token are held back for too long
+        access_token = access_token if access_token else config.as_token
+        headers = {
+            'Content-Type':'application/json',
+            'Authorization':'Bearer {}'.format(access_token)
+            }
+
+        url = config.hs_address + endpoint
+        template = metrics.endpoint_template(url)
+        if request_log.isEnabledFor(logging.DEBUG):
+            request_log.debug('request', extra=log.fields(method=method, url=url, body=json))
+
+        bucket = ratelimit.get_bucket(access_token)
+        # Waiting for the bucket sleeps, so don't do it on the event loop
+        await asyncio.get_running_loop().run_in_executor(None, bucket.acquire)
+
+        circuit = utils.get_circuit(url)
+        if not circuit.allow():
+            metrics.hs_rejected.inc(method, template)
+            raise utils.CircuitOpenError(f'Circuit to {config.hs_address} is open')
+
+        start = monotonic()
+        try:
+            async with self._session.request(method, url, json=json, headers=headers) as r:
+                try:
+                    body = await r.json(content_type=None)
+                except ValueError:
+                    body = None
+        except (ClientError, asyncio.TimeoutError) as e:
+            circuit.record_failure()
+            request_log.warning('request failed', extra=log.fields(method=method, url=url, error=repr(e)))
+            if isinstance(e, asyncio.TimeoutError):
+                raise Timeout(repr(e)) from e
+            raise ConnectionError(repr(e)) from e
+        circuit.record_success()
+
+        metrics.hs_request_seconds.observe(monotonic() - start, method, template)
+        metrics.hs_responses.inc(method, template, r.status)
+        if request_log.isEnabledFor(logging.DEBUG):
+            request_log.debug('response', extra=log.fields(method=method, url=url, status=r.status, body=body))
+
+        if r.status == 429:
+            retry_after_ms = body.get('retry_after_ms') if isinstance(body, dict) else None
+            retry_after = retry_after_ms / 1000 if retry_after_ms != None else config.ratelimit_default_retry_after
+            bucket.limited(retry_after)
+            metrics.rate_limited.inc()
+            request_log.info('rate limited', extra=log.fields(url=url, retry_after=retry_after, attempts=1))
+        else:
+            bucket.succeeded()
+        return r.status, body
+
+
+homeserver_key = web.AppKey('homeserver', AsyncHomeserver)
+executor_key = web.AppKey('executor', ThreadPoolExecutor)
+
+# Room ID -> [lock, number of users of the lock]
+room_locks = {}
+
+server_log = log.get('server')
+
+@asynccontextmanager
+async def room_lock(room_id):
+    # Keeps the events of a room in order, even across overlapping transactions
+    entry = room_locks.setdefault(room_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del room_locks[room_id]
+
+
+def call_in_app_context(fn, *args):
+    with app.app_context():
+        return fn(*args)
+
+async def run_sync(aioapp, fn, *args):
+    # Run synchronous bot logic on a worker thread, with its own DB connection
+    return await asyncio.get_running_loop().run_in_executor(
+        aioapp[executor_key], call_in_app_context, fn, *args)
+
+
+async def prefetch_display_names(aioapp, txn_events):
+    # Look up the names of message senders all at once, so relays of their messages find them cached.
+    # Don't hold up the transaction for this while the homeserver is failing: the relays will fail fast anyway.
+    if utils.get_circuit(config.hs_address).is_open():
+        return
+
+    mxids = set()
+    for i, event in txn_events:
+        sender = event.get('sender')
+        if event['type'] == 'm.room.message' and sender != config.as_botname and not display_names.lookup(sender)[0]:
+            mxids.add(sender)
+
+    mxids = list(mxids)
+    results = await asyncio.gather(
+        *(aioapp[homeserver_key].request('GET', f'/_matrix/client/r0/profile/{mxid}/displayname') for mxid in mxids),
+        return_exceptions=True)
+
+    for mxid, result in zip(mxids, results):
+        if not isinstance(result, Exception):
+            store_display_name(mxid, *result)
+
+async def handle_room_events(aioapp, txnId, room_id, room_events):
+    async with room_lock(room_id):
+        try:
+            return await run_sync(aioapp, handle_txn_events, txnId, room_events)
+        except Exception as e:
+            # Other rooms can still go ahead; this room's events get retried with the transaction
+            server_log.exception('failed to handle events of room', extra=log.fields(txnId=txnId, room_id=room_id))
+            return False, {}
+
+
+async def transactions(request):
+    response = validate_hs_token(request.query)
+    if response is not None:
+        body, status = response
+        return web.json_response(body, status=status)
+
+    start = monotonic()
+    aioapp = request.app
+    txnId = int(request.match_info['txnId'])
+    events = (await request.json())['events']
+    txn_events = await run_sync(aioapp, get_uncommitted_txn_events, txnId, events)
+    if workers.pool != None:
+        # The workers keep each room's events in order themselves
+        txn_success, seen_event_ids = await run_sync(aioapp, workers.handle_txn_events, txnId, txn_events)
+    else:
+        txn_success, seen_event_ids = await handle_txn_events_here(aioapp, txnId, txn_events)
+
+    receipts.update(seen_event_ids)
+
+    if txn_success:
+        await run_sync(aioapp, ack_txn, txnId)
+
+    metrics.txn_events.observe(len(events))
+    metrics.txn_seconds.observe(monotonic() - start)
+    return web.json_response({}, status=200 if txn_success else 500)
+
+async def handle_txn_events_here(aioapp, txnId, txn_events):
+    # Events of different rooms are independent, so handle each room's events concurrently
+    room_events = {}
+    for i, event in txn_events:
+        room_events.setdefault(event.get('room_id'), []).append((i, event))
+
+    await prefetch_display_names(aioapp, txn_events)
+    results = await asyncio.gather(
+        *(handle_room_events(aioapp, txnId, room_id, events) for room_id, events in room_events.items()))
+
+    txn_success = True
+    seen_event_ids = {}
+    for room_success, room_seen_event_ids in results:
+        txn_success = room_success and txn_success
+        seen_event_ids.update(room_seen_event_ids)
+    return txn_success, seen_event_ids
+
+async def get_metrics(request):
+    return web.Response(text=metrics.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+async def homeserver_ctx(aioapp):
+    homeserver = AsyncHomeserver()
+    await homeserver.start()
+    aioapp[homeserver_key] = homeserver
+    aioapp[executor_key] = ThreadPoolExecutor(max_workers=config.async_workers)
+
+    yield
+
+    aioapp[executor_key].shutdown()
+    await homeserver.close()
+
+def make_app():
+    aioapp = web.Application()
+    aioapp.router.add_put(r'/transactions/{txnId:\d+}', transactions)
+    aioapp.router.add_get('/metrics', get_metrics)
+    aioapp.cleanup_ctx.append(homeserver_ctx)
+    return aioapp
+
+def serve(host, port):
+    # Leave signals alone, so that the handlers installed by prep() still run
+    web.run_app(make_app(), host=host, port=port, handle_signals=False, print=None)
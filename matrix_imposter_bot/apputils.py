@@ -1,7 +1,10 @@
 from . import config
+from . import log
+from . import ratelimit
 from . import utils
 
 import re
+from threading import Lock
 
 
 class Linkable:
@@ -85,19 +88,115 @@ def is_room_id(room_id):
     return bool(room_pattern.fullmatch(room_id))
 
 
-def get_next_txnId():
-    conn = utils.get_db_conn()
-    c = conn.cursor()
-    c.execute('INSERT INTO transactions_out VALUES (null, 0)')
-    c.execute('SELECT txnId FROM transactions_out WHERE txnId=(SELECT MAX(txnId) FROM transactions_out)')
+def insert_reply_link(control_room, event_id, room_id, set_latest):
+    c = utils.get_db_conn().cursor()
+    c.execute('INSERT INTO reply_links VALUES (?, ?, ?)',
+        (control_room, event_id, room_id))
+    if set_latest:
+        utils.upsert(c, 'latest_reply_link', {'control_room': control_room, 'event_id': event_id},
+            key=('control_room',), update={'event_id': 'excluded.event_id'})
+
+
+# Outbound txnIds are reserved in blocks, and handed out from memory.
+# A block is only reserved between events (see top_up_txnIds), since a thread in the middle of an event
+# may hold the DB's write lock, or wait on another thread's. An event that uses up the block goes on with
+# IDs made by suffixing the block's last ID, which no other process or later run can be handed.
+# The block is replaced once the event is done.
+txnId_lock = Lock()
+next_txnId = 0
+txnId_limit = 0
+overflow_txnIds = 0
+# Highest txnId (or base of a suffixed one) the homeserver accepted, saved with each reservation
+committed_txnId = 0
+# Guards reserving, and the connection used for it, without holding up txnIds being handed out meanwhile
+reserve_lock = Lock()
+txnId_conn = None
+
+txnId_log = log.get('txn')
 
-    txnId = c.fetchone()[0]
-    return txnId
+def get_next_txnId():
+    global next_txnId, overflow_txnIds
+    with txnId_lock:
+        if next_txnId < txnId_limit:
+            txnId = next_txnId
+            next_txnId += 1
+            return str(txnId)
+        elif txnId_limit != 0:
+            overflow_txnIds += 1
+            return f'{txnId_limit - 1}.{overflow_txnIds}'
+
+    # Nothing was reserved yet
+    top_up_txnIds()
+    return get_next_txnId()
 
 def commit_txnId(txnId):
-    utils.get_db_conn().execute(
-        'UPDATE transactions_out SET committed=1 WHERE txnId=?', (txnId,))
-    # Not actually committing here, relying on HS to no-op re-requests
+    global committed_txnId
+    with txnId_lock:
+        committed_txnId = max(committed_txnId, int(txnId.partition('.')[0]))
+    # Not actually committing here: this is saved with the next reservation,
+    # and otherwise relying on HS to no-op re-requests
+
+def top_up_txnIds():
+    # Call this while the thread's DB connection has nothing uncommitted,
+    # so that reserving a block never has to wait on that connection's own lock.
+    global next_txnId, txnId_limit, overflow_txnIds
+    # If another thread is already reserving a block, leave it to that one, unless there is none to use yet
+    if not reserve_lock.acquire(blocking=txnId_limit == 0):
+        return
+    try:
+        with txnId_lock:
+            if txnId_limit - next_txnId >= config.txnId_block_size // 2:
+                return
+            committed = committed_txnId
+
+        try:
+            limit = reserve_txnIds(committed)
+        except Exception as e:
+            if txnId_limit == 0:
+                raise
+            # Such as when another thread's event holds SQLite's write lock for too long.
+            # Suffixed IDs will do until the next try.
+            txnId_log.warning('failed to reserve txnIds', extra=log.fields(error=str(e)))
+            return
+
+        with txnId_lock:
+            next_txnId = limit - config.txnId_block_size
+            txnId_limit = limit
+            overflow_txnIds = 0
+    finally:
+        reserve_lock.release()
+
+def reserve_txnIds(committed):
+    # Commit the reservation right away, on its own connection, so that no ID is handed out twice,
+    # even if the event that uses it is rolled back or the bot restarts.
+    # Returns the new limit. Caller holds reserve_lock.
+    global txnId_conn
+    if txnId_conn == None or utils.is_closed(txnId_conn):
+        txnId_conn = utils.connect(shared=True)
+    try:
+        return reserve_txnId_block(txnId_conn, committed)
+    except Exception:
+        if not utils.is_closed(txnId_conn):
+            raise
+        # The connection was lost, such as to a restart of the DB server, so try once more with a new one
+        txnId_conn = utils.connect(shared=True)
+        return reserve_txnId_block(txnId_conn, committed)
+
+def reserve_txnId_block(conn, committed):
+    # Returns the new limit
+    try:
+        c = conn.cursor()
+        c.execute('UPDATE txnId_blocks SET next_txnId=next_txnId+?, ' \
+            'committed_txnId=CASE WHEN committed_txnId>? THEN committed_txnId ELSE ? END',
+            (config.txnId_block_size, committed, committed))
+        c.execute('SELECT next_txnId FROM txnId_blocks')
+        limit = c.fetchone()[0]
+        conn.commit()
+        return limit
+    except Exception:
+        if not utils.is_closed(conn):
+            conn.rollback()
+        raise
 
 
 def mx_request(method, endpoint, json=None, access_token=None, verbose=True, **kwargs):
@@ -112,37 +211,70 @@ def mx_request(method, endpoint, json=None, access_token=None, verbose=True, **k
         slash_index = endpoint.rfind('/') + 1
         if endpoint[slash_index:] == 'txnId':
             txnId = get_next_txnId()
-            endpoint = endpoint[:slash_index] + str(txnId)
+            endpoint = endpoint[:slash_index] + txnId
 
-    r = utils.make_request(method, config.hs_address + endpoint, json, headers, verbose, **kwargs)
+    r = ratelimit.send(access_token if access_token else config.as_token,
+        lambda: utils.make_request(method, config.hs_address + endpoint, json, headers, verbose, **kwargs))
 
-    # TODO handle failure
     if txnId != None and r.status_code == 200:
         commit_txnId(txnId)
 
     return r
 
 
+room_names = utils.TTLCache(config.cache_size, config.cache_ttl, config.cache_negative_ttl)
+display_names = utils.TTLCache(config.cache_size, config.cache_ttl, config.cache_negative_ttl)
+
 def get_room_name(room_id):
-    # TODO cache this in the DB!!
+    hit, name = room_names.lookup(room_id)
+    if hit:
+        return name
+
     r = mx_request('GET', f'/_matrix/client/r0/rooms/{room_id}/state/m.room.name')
     if r.status_code == 200:
-        return r.json()['name']
+        name = r.json()['name']
+        room_names.put(room_id, name)
+        return name
     elif r.status_code == 404:
         r = mx_request('GET', f'/_matrix/client/r0/rooms/{room_id}/state/m.room.canonical_alias')
         if r.status_code == 200:
-            return r.json()['alias']
+            name = r.json()['alias']
+            room_names.put(room_id, name)
+            return name
         elif r.status_code == 404:
-            return 'Unnamed room'
+            name = 'Unnamed room'
+            room_names.put(room_id, name, negative=True)
+            return name
 
     # TODO This is really an error condition, but making it fatal is annoying
     return 'Unknown room'
 
 def get_display_name(mxid):
-    # TODO cache this in the DB!!
+    hit, name = display_names.lookup(mxid)
+    if hit:
+        return name
+
     # TODO consider failing on network error. But not failing makes it much easier.
     r = mx_request('GET', f'/_matrix/client/r0/profile/{mxid}/displayname')
-    return r.json()['displayname'] if r.status_code == 200 else None
+    return store_display_name(mxid, r.status_code, r.json() if r.status_code == 200 else None)
+
+def store_display_name(mxid, status_code, json):
+    # Caches the outcome of a displayname lookup, however it was requested
+    if status_code == 200:
+        name = json['displayname']
+        display_names.put(mxid, name)
+        return name
+    elif status_code == 404:
+        display_names.put(mxid, None, negative=True)
+    return None
+
+def invalidate_room_name(room_id):
+    room_names.invalidate(room_id)
+    utils.announce_invalidation(invalidate_room_name, room_id)
+
+def invalidate_display_name(mxid):
+    display_names.invalidate(mxid)
+    utils.announce_invalidation(invalidate_display_name, mxid)
 
 
 def post_message(room_id, message_plain, message_html=None, access_token=None):
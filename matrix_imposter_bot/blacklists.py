@@ -0,0 +1,116 @@
+import re
+from threading import Lock
+
+from . import utils
+
+# Each (mimic_user, room_id) gets its blacklist in effect (room-specific, or else global)
+# compiled into one pattern, which is cached until the blacklists involved change.
+
+lock = Lock()
+# (mimic_user, room_id) -> matcher, or None for no blacklist
+matchers = {}
+# Bumped whenever matchers are dropped, so that matchers loaded from before that aren't stored
+generation = 0
+
+
+class WordsMatcher:
+    # Fallback for blacklists whose words can't be combined into one pattern
+    def __init__(self, words):
+        self._patterns = [re.compile(word) for word in words]
+
+    def match(self, string):
+        for pattern in self._patterns:
+            if pattern.match(string):
+                return True
+        return None
+
+def compile_blacklist(blacklist):
+    if blacklist == None:
+        return None
+
+    words = blacklist.split()
+    if len(words) == 0:
+        return None
+
+    try:
+        return re.compile('|'.join(f'(?:{word})' for word in words))
+    except re.error:
+        # Such as for words with global flags, which are only allowed at the start of a pattern
+        return WordsMatcher(words)
+
+
+def load_matchers(mimic_user, room_ids):
+    # Reads all of the mimic user's blacklists at once
+    with lock:
+        load_generation = generation
+    blacklists = {}
+    c = utils.get_db_conn().cursor()
+    for row in c.execute('SELECT room_id, blacklist FROM blacklists WHERE mimic_user=?', (mimic_user,)):
+        blacklists[row[0]] = row[1]
+
+    # The global blacklist is stored with a NULL room ID
+    global_matcher = compile_blacklist(blacklists.get(None))
+    loaded = {}
+    for room_id in room_ids:
+        loaded[(mimic_user, room_id)] = \
+            compile_blacklist(blacklists[room_id]) if room_id in blacklists else global_matcher
+
+    with lock:
+        if generation == load_generation:
+            matchers.update(loaded)
+    return loaded
+
+def get_matchers(mimic_user, room_ids):
+    found = {}
+    missing = []
+    with lock:
+        for room_id in room_ids:
+            key = (mimic_user, room_id)
+            if key in matchers:
+                found[key] = matchers[key]
+            else:
+                missing.append(room_id)
+
+    if len(missing) != 0:
+        found.update(load_matchers(mimic_user, missing))
+    return found
+
+def get_matcher(mimic_user, room_id):
+    return get_matchers(mimic_user, [room_id])[(mimic_user, room_id)]
+
+
+def is_blacklisted(target_user, mimic_user, room_id):
+    matcher = get_matcher(mimic_user, room_id)
+    return matcher != None and bool(matcher.match(target_user))
+
+def get_blacklisted_senders(senders, mimic_user, room_id):
+    matcher = get_matcher(mimic_user, room_id)
+    if matcher == None:
+        return set()
+    return {sender for sender in senders if matcher.match(sender)}
+
+def get_unblacklisted_rooms(target_user, room_mimic_users):
+    # Takes (room_id, mimic_user) pairs, and returns the ones where target_user isn't blacklisted
+    room_ids_by_mimic_user = {}
+    for room_id, mimic_user in room_mimic_users:
+        room_ids_by_mimic_user.setdefault(mimic_user, []).append(room_id)
+
+    room_matchers = {}
+    for mimic_user, room_ids in room_ids_by_mimic_user.items():
+        room_matchers.update(get_matchers(mimic_user, room_ids))
+
+    return [(room_id, mimic_user) for room_id, mimic_user in room_mimic_users
+        if not (room_matchers[(mimic_user, room_id)] and room_matchers[(mimic_user, room_id)].match(target_user))]
+
+
+def drop_matchers(mimic_user=None, room_id=None):
+    global generation
+    with lock:
+        generation += 1
+        for key in list(matchers):
+            if (mimic_user == None or key[0] == mimic_user) and (room_id == None or key[1] == room_id):
+                del matchers[key]
+
+def invalidate(mimic_user=None, room_id=None):
+    # Call this when changing the blacklists of a mimic user and/or room (None means any)
+    utils.invalidate(drop_matchers, mimic_user, room_id)
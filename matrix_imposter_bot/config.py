@@ -14,9 +14,59 @@ hs_token = reg_settings['hs_token']
 
 hs_address = cfg_settings['homeserver']['address']
 hs_domain = cfg_settings['homeserver']['domain']
+hs_pool_size = cfg_settings['homeserver'].get('pool_size', 10)
+hs_connect_timeout = cfg_settings['homeserver'].get('connect_timeout', 5)
+hs_timeout = cfg_settings['homeserver'].get('timeout', 30)
+hs_retry_attempts = cfg_settings['homeserver'].get('retry_attempts', 3)
+hs_retry_base_delay = cfg_settings['homeserver'].get('retry_base_delay', 0.5)
+hs_retry_max_delay = cfg_settings['homeserver'].get('retry_max_delay', 30)
+hs_circuit_threshold = cfg_settings['homeserver'].get('circuit_threshold', 5)
+hs_circuit_reset = cfg_settings['homeserver'].get('circuit_reset', 30)
 
-db_name = cfg_settings['appservice']['db_name']
+db_engine = cfg_settings['appservice'].get('db_engine', 'sqlite')
+db_name = cfg_settings['appservice'].get('db_name')
+db_dsn = cfg_settings['appservice'].get('db_dsn')
+db_pool_size = cfg_settings['appservice'].get('db_pool_size', 20)
+db_synchronous = cfg_settings['appservice'].get('db_synchronous', 'NORMAL')
+db_statement_cache = cfg_settings['appservice'].get('db_statement_cache', 256)
+db_busy_timeout = cfg_settings['appservice'].get('db_busy_timeout', 5)
+async_workers = cfg_settings['appservice'].get('async_workers', 8)
+outbox_workers = cfg_settings['appservice'].get('outbox_workers', 4)
+outbox_retry_interval = cfg_settings['appservice'].get('outbox_retry_interval', 30)
+outbox_max_attempts = cfg_settings['appservice'].get('outbox_max_attempts', 10)
+receipt_interval = cfg_settings['appservice'].get('receipt_interval', 5)
+txnId_block_size = cfg_settings['appservice'].get('txnId_block_size', 1000)
+txn_retention = cfg_settings['appservice'].get('txn_retention', 3600)
+dedupe_window = cfg_settings['appservice'].get('dedupe_window', 86400)
+dedupe_capacity = cfg_settings['appservice'].get('dedupe_capacity', 100000)
+presence_interval = cfg_settings['appservice'].get('presence_interval', 20)
+prune_interval = cfg_settings['appservice'].get('prune_interval', 600)
+job_jitter = cfg_settings['appservice'].get('job_jitter', 0.1)
+startup_workers = cfg_settings['appservice'].get('startup_workers', 8)
+register_attempts = cfg_settings['appservice'].get('register_attempts', 5)
+seed_interval = cfg_settings['appservice'].get('seed_interval', 60)
+digest_window = cfg_settings['appservice'].get('digest_window', 5)
+digest_max_messages = cfg_settings['appservice'].get('digest_max_messages', 20)
+workers = cfg_settings['appservice'].get('workers', 0)
 
 as_botname = '@{}:{}'.format(reg_settings['sender_localpart'], hs_domain)
 as_disname = cfg_settings['bot']['displayname']
 as_avatar =  cfg_settings['bot']['avatar']
+
+cache_settings = cfg_settings.get('cache', {})
+cache_size = cache_settings.get('size', 1024)
+cache_ttl = cache_settings.get('ttl', 600)
+cache_negative_ttl = cache_settings.get('negative_ttl', 60)
+
+ratelimit_settings = cfg_settings.get('ratelimit', {})
+ratelimit_rate = ratelimit_settings.get('rate', 5)
+ratelimit_burst = ratelimit_settings.get('burst', 10)
+ratelimit_queue_size = ratelimit_settings.get('queue_size', 50)
+ratelimit_max_wait = ratelimit_settings.get('max_wait', 30)
+ratelimit_attempts = ratelimit_settings.get('attempts', 3)
+ratelimit_default_retry_after = ratelimit_settings.get('default_retry_after', 1)
+
+log_settings = cfg_settings.get('logging', {})
+log_level = log_settings.get('level', 'info')
+log_levels = log_settings.get('levels', {})
+log_sampling = log_settings.get('sampling', {})
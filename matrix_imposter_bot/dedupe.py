@@ -0,0 +1,98 @@
+from hashlib import blake2b
+from math import ceil, log
+from threading import Lock
+from time import time
+
+from . import config
+from . import utils
+
+# Messages the bot generated are remembered in the generated_messages table for a limited window.
+# Bloom filters in front of it answer most lookups (that is, for messages the bot didn't generate)
+# without touching the DB.
+# That only works if the filters of the process that looks a message up have every message added to them.
+# In multi-worker mode, messages recorded by the front process (like digests) are added to the workers' filters
+# with remember, once they are committed.
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.01):
+        self._size = ceil(-capacity * log(error_rate) / log(2)**2)
+        self._hashes = max(1, round(self._size / capacity * log(2)))
+        self._bits = bytearray(ceil(self._size / 8))
+
+    def _positions(self, key):
+        digest = blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little')
+        return ((h1 + i * h2) % self._size for i in range(self._hashes))
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+lock = Lock()
+# Two generations of filters, each covering up to one window, so that old entries age out
+current = None
+previous = None
+rotated_at = 0
+
+
+def get_key(event_id, room_id):
+    return f'{room_id} {event_id}'
+
+def rotate_if_due(now):
+    # Caller holds lock
+    global current, previous, rotated_at
+    if now - rotated_at >= config.dedupe_window:
+        previous = current
+        current = BloomFilter(config.dedupe_capacity)
+        rotated_at = now
+
+def load():
+    # Caller holds lock
+    global current, previous, rotated_at
+    now = time()
+    current = BloomFilter(config.dedupe_capacity)
+    previous = None
+    rotated_at = now
+    c = utils.get_db_conn().cursor()
+    for row in c.execute('SELECT event_id, room_id FROM generated_messages WHERE sent_at>=?', (now - config.dedupe_window,)):
+        current.add(get_key(*row))
+
+
+def record(event_id, room_id):
+    now = time()
+    conn = utils.get_db_conn()
+    conn.execute('INSERT INTO generated_messages VALUES (?, ?, ?)', (event_id, room_id, now))
+    remember(event_id, room_id)
+
+def remember(event_id, room_id):
+    # Adds a message recorded in the DB to this process' filters
+    with lock:
+        if current == None:
+            load()
+        rotate_if_due(time())
+        current.add(get_key(event_id, room_id))
+
+def was_generated(event_id, room_id):
+    key = get_key(event_id, room_id)
+    with lock:
+        if current == None:
+            load()
+        rotate_if_due(time())
+        maybe = key in current or (previous != None and key in previous)
+
+    if not maybe:
+        return False
+
+    return utils.fetchone_single(
+        utils.get_db_conn().execute('SELECT 1 FROM generated_messages WHERE event_id=? AND room_id=?', (event_id, room_id))) != None
+
+def prune():
+    conn = utils.get_db_conn()
+    conn.execute('DELETE FROM generated_messages WHERE sent_at<?', (time() - config.dedupe_window,))
+    conn.commit()
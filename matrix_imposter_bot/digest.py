@@ -0,0 +1,197 @@
+import json
+from itertools import takewhile
+from time import time
+
+from requests.exceptions import RequestException
+
+from . import config
+from . import dedupe
+from . import log
+from . import metrics
+from . import outbox
+from . import routing
+from . import utils
+from . import workers
+from .apputils import mx_request, MxRoomLink, MxUserLink
+
+# In rooms set to digest mode, relays are written to the digest_buffer table as part of the event
+# that caused them, and a background job sends each room's buffered relays as one combined message,
+# once the oldest of them has waited for digest_window (or enough of them are buffered to fill one).
+# Only plain messages are combined. Others (like media, replies and edits) are relayed as they are:
+# right away if nothing is buffered for the room, or else by the background job, after the relays before them.
+# Rooms are turned out of digest mode by that job too, once it has emptied their buffer,
+# so that relays sent right away never overtake buffered ones.
+
+digest_log = log.get('event')
+
+COMBINABLE_MSGTYPES = ['m.text', 'm.notice', 'm.emote']
+
+
+def can_combine(content):
+    return content.get('msgtype') in COMBINABLE_MSGTYPES and 'url' not in content and 'm.relates_to' not in content
+
+def lock_room(mimic_user, room_id):
+    # Returns whether the room is (still) in digest mode.
+    # Turning a room out of digest mode locks it the same way, and must wait for this to be committed (or vice versa),
+    # so that nothing gets buffered for a room after it was found to have nothing buffered.
+    c = utils.get_db_conn().execute('UPDATE digest_rooms SET enabled=enabled WHERE mimic_user=? AND room_id=?',
+        (mimic_user, room_id))
+    return c.rowcount != 0
+
+def is_buffered(room_id):
+    # Relays are only deleted from the buffer after they are sent, so none are on their way if it's empty
+    c = utils.get_db_conn().execute('SELECT 1 FROM digest_buffer WHERE room_id=? LIMIT 1', (room_id,))
+    return utils.fetchone_single(c) != None
+
+def buffer(route, room_id, event_id, sender, content):
+    # Returns False if the message must be relayed right away instead
+    if not lock_room(route.mimic_user, room_id):
+        # The route was out of date
+        return False
+
+    combinable = can_combine(content)
+    if not combinable and not is_buffered(room_id):
+        return False
+
+    utils.get_db_conn().execute(
+        'INSERT INTO digest_buffer (room_id, event_id, sender, body, formatted_body, content, buffered_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        (room_id, event_id, sender, content['body'], content.get('formatted_body'),
+            json.dumps(content) if not combinable else None, time()))
+    return True
+
+def end_digest_mode(mimic_user, room_id):
+    # Returns whether the room was turned out of digest mode, which only happens once none of its relays are left buffered.
+    # Until then, it is only marked to be turned out of it.
+    c = utils.get_db_conn().cursor()
+    c.execute('UPDATE digest_rooms SET enabled=0 WHERE mimic_user=? AND room_id=?', (mimic_user, room_id))
+    if is_buffered(room_id):
+        return False
+    c.execute('DELETE FROM digest_rooms WHERE mimic_user=? AND room_id=?', (mimic_user, room_id))
+    return True
+
+def discard(room_id):
+    # Call this when the mimic user of a room stops relaying it, since what was buffered for them
+    # mustn't be sent later as someone else, or after relays sent since then
+    c = utils.get_db_conn().execute('DELETE FROM digest_buffer WHERE room_id=?', (room_id,))
+    if c.rowcount != 0:
+        digest_log.info('discarding buffered relays', extra=log.fields(room_id=room_id, count=c.rowcount))
+
+
+def build_content(rows):
+    from .main import prepend_with_author
+    plain = []
+    html = []
+    for id, event_id, sender, body, formatted_body, content, buffered_at, attempts in rows:
+        sender_info = MxUserLink(sender)
+        plain.append(prepend_with_author(body, sender_info, False))
+        html.append(prepend_with_author(formatted_body if formatted_body != None else body, sender_info, True))
+
+    return {
+        'msgtype': 'm.text',
+        'body': '\n\n'.join(plain),
+        'format': 'org.matrix.custom.html',
+        'formatted_body': '<br><br>'.join(html)
+    }
+
+def send_buffered(room_id, rows):
+    # Sends either one message that can't be combined, or several that are combined into one.
+    # Returns False if they must be retried later.
+    from .main import relay_message, control_room_notify, notify_expired_token
+    conn = utils.get_db_conn()
+    route = routing.get_route(room_id)
+    sent_event_id = None
+    if route.mimic_user == None or route.access_token == None:
+        digest_log.info('dropping buffered relays of room without a mimic user', extra=log.fields(room_id=room_id, count=len(rows)))
+    else:
+        id, event_id, sender, body, formatted_body, content, buffered_at, attempts = rows[0]
+        try:
+            if content != None:
+                r = relay_message(route, room_id, event_id, sender, json.loads(content))
+            else:
+                r = mx_request('PUT',
+                    f'/_matrix/client/r0/rooms/{room_id}/send/m.room.message/txnId',
+                    json=build_content(rows),
+                    access_token=route.access_token)
+            status_code = r.status_code
+        except RequestException:
+            status_code = None
+
+        if status_code == 200:
+            sent_event_id = r.json()['event_id']
+            if content == None:
+                dedupe.record(sent_event_id, room_id)
+                metrics.digests.inc()
+                metrics.relays.inc(amount=len(rows))
+                if route.replace:
+                    for row in rows:
+                        outbox.enqueue_redaction(room_id, row[1])
+        elif status_code == None or status_code == 429 or status_code >= 500:
+            return False
+        elif r.json().get('errcode') == 'M_UNKNOWN_TOKEN':
+            control_room_notify(route.mimic_user, MxRoomLink(room_id), notify_expired_token)
+        else:
+            digest_log.warning('dropping buffered relays', extra=log.fields(room_id=room_id, count=len(rows), status=status_code))
+
+    conn.executemany('DELETE FROM digest_buffer WHERE id=?', [(row[0],) for row in rows])
+    conn.commit()
+    if sent_event_id != None:
+        # The worker that gets the room's events must know not to relay what was sent here
+        workers.run_everywhere(dedupe.remember, sent_event_id, room_id)
+    outbox.wake_if_enqueued()
+    return True
+
+def flush_room(room_id, now):
+    # Returns False if buffered relays must be retried later
+    conn = utils.get_db_conn()
+    c = conn.cursor()
+    while True:
+        c.execute('SELECT id, event_id, sender, body, formatted_body, content, buffered_at, attempts FROM digest_buffer ' \
+            'WHERE room_id=? ORDER BY id LIMIT ?', (room_id, config.digest_max_messages))
+        rows = c.fetchall()
+        if len(rows) == 0:
+            return True
+
+        # A message that can't be combined goes on its own, and any before it are combined without it
+        rows = rows[:1] if rows[0][5] != None else list(takewhile(lambda row: row[5] == None, rows))
+        attempts = max(row[7] for row in rows)
+
+        # Combined relays wait for the window to pass since the oldest of them was buffered, unless there are enough
+        # to fill a message. One that can't be combined was only buffered to keep it after those, so it needn't wait.
+        # Either way, relays wait for another window after each failed attempt.
+        go_now = attempts == 0 and (rows[0][5] != None or len(rows) == config.digest_max_messages)
+        if not go_now and rows[0][6] + config.digest_window > now:
+            return True
+
+        if attempts >= config.outbox_max_attempts:
+            digest_log.warning('dropping buffered relays', extra=log.fields(room_id=room_id, count=len(rows), attempts=attempts))
+            c.executemany('DELETE FROM digest_buffer WHERE id=?', [(row[0],) for row in rows])
+            conn.commit()
+            continue
+
+        # Count the attempt before making it, like the outbox does, and start waiting again from now
+        c.executemany('UPDATE digest_buffer SET attempts=?, buffered_at=? WHERE id=?', [(attempts + 1, now, row[0]) for row in rows])
+        conn.commit()
+
+        if not send_buffered(room_id, rows):
+            return False
+
+def flush():
+    # Run periodically by the scheduler
+    conn = utils.get_db_conn()
+    c = conn.cursor()
+    now = time()
+    room_ids = [row[0] for row in c.execute('SELECT DISTINCT room_id FROM digest_buffer')]
+    for room_id in room_ids:
+        if not flush_room(room_id, now):
+            digest_log.warning('failed to send buffered relays', extra=log.fields(room_id=room_id))
+
+    # Finish turning rooms out of digest mode, once nothing of theirs is left buffered
+    ended = False
+    c.execute('SELECT mimic_user, room_id FROM digest_rooms WHERE enabled=0')
+    for mimic_user, room_id in c.fetchall():
+        ended = end_digest_mode(mimic_user, room_id) or ended
+    if ended:
+        routing.invalidate()
+    conn.commit()
+    if ended:
+        workers.invalidate_everywhere(routing.drop_routes)
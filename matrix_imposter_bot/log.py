@@ -0,0 +1,77 @@
+import json
+import logging
+import random
+import sys
+
+from . import config
+
+# Log entries are written as one line of JSON each, in categories that can be given their own level.
+# Call sites pass structured fields with fields(...), and only serialize them if an entry is written.
+#
+# Categories:
+#   request  requests to the homeserver & their responses
+#   event    incoming events
+#   txn      progress of incoming transactions
+#   outbox   control room notices sent in the background
+#   server   the appservice itself (startup, shutdown, errors)
+
+ROOT = 'imposter'
+
+# For dumps that are too chatty even for debug, like background requests
+TRACE = 5
+logging.addLevelName(TRACE, 'TRACE')
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': round(record.created, 3),
+            'level': record.levelname.lower(),
+            'category': record.name[len(ROOT)+1:],
+            'msg': record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class Sampler(logging.Filter):
+    # Keeps only a fraction of a category's entries below warning level
+    def __init__(self, rate):
+        super().__init__()
+        self._rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self._rate
+
+
+def get(category):
+    return logging.getLogger(f'{ROOT}.{category}')
+
+def fields(**kwargs):
+    # Use as the extra= of a logging call
+    return {'fields': kwargs}
+
+
+is_set_up = False
+
+def setup():
+    global is_set_up
+    if is_set_up:
+        return
+    is_set_up = True
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JSONFormatter())
+
+    root = logging.getLogger(ROOT)
+    root.addHandler(handler)
+    root.setLevel(config.log_level.upper())
+    root.propagate = False
+
+    for category, level in config.log_levels.items():
+        get(category).setLevel(level.upper())
+
+    for category, rate in config.log_sampling.items():
+        if rate < 1:
+            get(category).addFilter(Sampler(rate))
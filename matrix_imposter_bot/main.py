@@ -1,21 +1,42 @@
-import re
+from time import monotonic, time
 from traceback import format_exception
 
 from flask import request
-from sqlite3 import IntegrityError
+from requests.exceptions import RequestException
 
 from . import app
+from . import blacklists
 from . import config
+from . import dedupe
+from . import digest
+from . import log
 from . import messages
+from . import metrics
+from . import outbox
+from . import receipts
+from . import routing
 from . import utils
-from .apputils import mx_request, post_message, post_message_status, MxRoomLink, MxUserLink, is_room_id
+from . import workers
+from .apputils import mx_request, post_message, post_message_status, MxRoomLink, MxUserLink, is_room_id, \
+    invalidate_room_name, invalidate_display_name, insert_reply_link, top_up_txnIds
+from .routing import is_control_room, get_control_room_user
 
 CONTROL_ROOM_NAME = 'ImposterBot control room'
 
+event_log = log.get('event')
+txn_log = log.get('txn')
+
 @app.teardown_appcontext
 def teardown(exc):
     utils.close_db_conn()
 
+@app.errorhandler(RequestException)
+def homeserver_failed(e):
+    # The homeserver couldn't be reached even after retrying, or its circuit is open.
+    # Events handled so far stay committed, and the homeserver will send the transaction again.
+    txn_log.warning('request to homeserver failed', extra=log.fields(error=str(e)))
+    return ({'errcode': 'M_UNKNOWN', 'error': 'Homeserver request failed'}, 500)
+
 
 def validate_hs_token(request_args):
     if 'access_token' not in request_args:
@@ -25,97 +46,165 @@ def validate_hs_token(request_args):
     return None
 
 
+# Events done in a transaction are kept as bitmaps of their indexes, with this many bits per row
+TXN_CHUNK_BITS = 63
+
 def get_committed_txn_event_idxs(txnId):
-    print(f'\n!!!\nreceiving txnId = {txnId}')
-    ret = []
+    # Returns None if the whole transaction was already handled
+    txn_log.debug('receiving transaction', extra=log.fields(txnId=txnId))
     c = utils.get_db_conn().cursor()
-    for row in c.execute('SELECT event_idx FROM transactions_in WHERE txnId=(?)', (txnId,)):
-        ret.append(row[0])
-    print(f'Events we saw already = {ret}')
+    c.execute('SELECT 1 FROM acked_transactions WHERE txnId=?', (txnId,))
+    if utils.fetchone_single(c):
+        txn_log.debug('transaction was already answered', extra=log.fields(txnId=txnId))
+        return None
+
+    ret = []
+    for row in c.execute('SELECT chunk, bitmap FROM transactions_in_progress WHERE txnId=? ORDER BY chunk', (txnId,)):
+        chunk, bitmap = row
+        for bit in range(TXN_CHUNK_BITS):
+            if bitmap & (1 << bit):
+                ret.append(chunk * TXN_CHUNK_BITS + bit)
+    txn_log.debug('events seen already', extra=log.fields(txnId=txnId, event_idxs=ret))
     return ret
 
 def commit_txn_event(txnId, event_idx):
-    print(f'Successfully handled event #{event_idx} of txnId = {txnId}')
+    txn_log.debug('handled event', extra=log.fields(txnId=txnId, event_idx=event_idx))
     conn = utils.get_db_conn()
-    conn.execute('INSERT INTO transactions_in VALUES (?, ?)', (txnId, event_idx))
+    # OR the bit in, since other threads may be committing other events of the same transaction
+    utils.upsert(conn, 'transactions_in_progress',
+        {'txnId': txnId, 'chunk': event_idx // TXN_CHUNK_BITS, 'bitmap': 1 << (event_idx % TXN_CHUNK_BITS)},
+        key=('txnId', 'chunk'), update={'bitmap': 'transactions_in_progress.bitmap|excluded.bitmap'})
     # This will commit everything done during the event!
     conn.commit()
+    utils.settle_invalidations()
+    outbox.wake_if_enqueued()
 
+def ack_txn(txnId):
+    # Once a transaction succeeds, the homeserver moves on and never resends it or any earlier one.
+    # Only remember that it was answered, for a while, in case our response got lost.
+    now = time()
+    conn = utils.get_db_conn()
+    utils.upsert(conn, 'acked_transactions', {'txnId': txnId, 'acked_at': now},
+        key=('txnId',), update={'acked_at': 'excluded.acked_at'})
+    conn.execute('DELETE FROM transactions_in_progress WHERE txnId<=?', (txnId,))
+    conn.commit()
 
-def get_listening_room_users(room_id, exclude_users=[]):
-    bot_in_room = True
+def prune_acked_transactions():
+    conn = utils.get_db_conn()
+    conn.execute('DELETE FROM acked_transactions WHERE acked_at<?', (time() - config.txn_retention,))
+    conn.commit()
+
+
+# Times to fetch a room's members while seeding it, if member events keep changing them in the meantime
+SEED_ATTEMPTS = 3
+
+def sync_room_members(room_id):
+    # Seed the membership mirror of a monitored room, once: this happens when the bot joins it, or at startup
+    # (or later, if those failed).
+    # After that, it is kept current by the member events of the room.
+    c = utils.get_db_conn().cursor()
+    c.execute('SELECT 1 FROM synced_rooms WHERE room_id=?', (room_id,))
+    if utils.fetchone_single(c):
+        return True
+
+    for attempt in range(SEED_ATTEMPTS):
+        c.execute('SELECT members_version FROM rooms WHERE room_id=?', (room_id,))
+        members_version = utils.fetchone_single(c)
+        if members_version == None:
+            return False
+
+        members = fetch_joined_members(room_id)
+        if members == None:
+            return False
+
+        # Lock the room against member events until this is committed, unless one was handled during the fetch,
+        # since the fetched members might not include its change. Then fetch them again.
+        c.execute('UPDATE rooms SET members_version=members_version WHERE room_id=? AND members_version=?',
+            (room_id, members_version))
+        if c.rowcount != 0:
+            break
+    else:
+        return False
+
+    c.execute('DELETE FROM room_members WHERE room_id=?', (room_id,))
+    c.executemany('INSERT INTO room_members VALUES (?, ?)', [(room_id, member) for member in members])
+    # Another thread may have seeded it in the meantime
+    utils.upsert(c, 'synced_rooms', {'room_id': room_id})
+    return True
+
+def fetch_joined_members(room_id):
+    # Returns None if the members couldn't be found
     r = mx_request('GET', f'/_matrix/client/r0/rooms/{room_id}/joined_members')
-    if r.status_code == 403:
+    if r.status_code == 200:
+        return list(r.json()['joined'])
+    elif r.status_code == 403:
         # Fall back to other API which remembers users of room bot used to be in
-        bot_in_room = False
         r = mx_request('GET', f'/_matrix/client/r0/rooms/{room_id}/members?membership=join')
-    elif r.status_code != 200:
+        if r.status_code != 200:
+            return None
+        return [member_event['state_key'] for member_event in r.json()['chunk']]
+    else:
         return None
 
-    # A listening user is a user with a control room.
-    listening_users = set()
-    c = utils.get_db_conn().cursor()
-    for row in c.execute('SELECT mxid FROM control_rooms'):
-        listening_users.add(row[0])
-
-    users = set()
-    if bot_in_room:
-        for member in r.json()['joined']:
-            users.add(member)
+def update_room_member(room_id, mxid, membership):
+    # Rooms that were never seeded are left alone, as seeding them will pick up this change anyway.
+    # A seed that is under way is told to, by bumping the room's members_version.
+    conn = utils.get_db_conn()
+    conn.execute('UPDATE rooms SET members_version=members_version+1 WHERE room_id=?', (room_id,))
+    if membership == 'join':
+        utils.upsert(conn, 'room_members', {'room_id': room_id, 'mxid': mxid},
+            where='EXISTS (SELECT 1 FROM synced_rooms WHERE room_id=?)', where_params=(room_id,))
     else:
-        for member_event in r.json()['chunk']:
-            users.add(member_event['state_key'])
-
-    return users.difference(exclude_users).intersection(listening_users)
+        conn.execute('DELETE FROM room_members WHERE room_id=? AND mxid=?', (room_id, mxid))
 
+def get_room_members(room_id):
+    if not sync_room_members(room_id):
+        return None
 
-def is_user_in_monitored_room(mxid, room_id):
-    # TODO consider caching room memberships in the DB
     c = utils.get_db_conn().cursor()
-    c.execute('SELECT 1 FROM rooms WHERE room_id=?', (room_id,))
-    if not utils.fetchone_single(c):
-        return False
+    return {row[0] for row in c.execute('SELECT mxid FROM room_members WHERE room_id=?', (room_id,))}
 
-    r = mx_request('GET', f'/_matrix/client/r0/rooms/{room_id}/joined_members')
-    if r.status_code != 200:
-        return False
 
-    return mxid in r.json()['joined']
+def get_listening_room_users(room_id, exclude_users=[]):
+    if not sync_room_members(room_id):
+        return None
 
-def get_rooms_for_user(mxid):
-    # TODO consider caching room memberships in the DB
-    room_list = []
+    # A listening user is a user with a control room.
+    users = set()
     c = utils.get_db_conn().cursor()
-    for row in c.execute('SELECT room_id FROM rooms'):
-        room_id = row[0]
-        r = mx_request('GET', f'/_matrix/client/r0/rooms/{room_id}/joined_members')
-        if r.status_code == 200 and mxid in r.json()['joined']:
-            room_list.append(room_id)
-    return room_list
+    for row in c.execute('SELECT mxid FROM room_members JOIN control_rooms USING (mxid) WHERE room_members.room_id=?', (room_id,)):
+        users.add(row[0])
 
-def get_placeholders_for_room_list(room_list):
-    return f'{",".join(["?"]*len(room_list))}'
+    return users.difference(exclude_users)
 
 
-def is_user_blacklisted(target_user, mimic_user, room_id):
-    c = utils.get_db_conn().cursor()
-    c.execute('SELECT blacklist FROM blacklists WHERE mimic_user=? AND room_id=?', (mimic_user, room_id))
-    row = c.fetchone()
-    if row == None:
-        c.execute('SELECT blacklist FROM blacklists WHERE mimic_user=? AND room_id is NULL', (mimic_user,))
-        row = c.fetchone()
-    blacklist = row[0] if row != None else None
+def is_user_in_monitored_room(mxid, room_id):
+    if not sync_room_members(room_id):
+        return False
 
-    if blacklist != None:
-        for blacklist_word in blacklist.split():
-            if re.match(blacklist_word, target_user):
-                return True
+    return utils.fetchone_single(
+        utils.get_db_conn().execute('SELECT 1 FROM room_members WHERE room_id=? AND mxid=?', (room_id, mxid))) != None
 
-    return False
+def seed_unmirrored_rooms():
+    # Run periodically by the scheduler, for monitored rooms that couldn't be seeded when the bot joined them or at startup.
+    # Until they are, they are left out of status and actions.
+    conn = utils.get_db_conn()
+    c = conn.cursor()
+    c.execute('SELECT room_id FROM rooms WHERE room_id NOT IN (SELECT room_id FROM synced_rooms)')
+    for row in c.fetchall():
+        room_id = row[0]
+        try:
+            if sync_room_members(room_id):
+                conn.commit()
+                event_log.info('seeded room members', extra=log.fields(room_id=room_id))
+        except RequestException as e:
+            conn.rollback()
+            event_log.warning('failed to seed room members', extra=log.fields(room_id=room_id, error=str(e)))
 
 
 def insert_control_room(mxid, room_id):
     utils.get_db_conn().execute('INSERT INTO control_rooms VALUES (?, ?, NULL)', (mxid, room_id))
+    routing.invalidate(room_id, mxid)
 
 def find_or_prepare_control_room(mxid):
     control_room = find_existing_control_room(mxid)
@@ -150,32 +239,12 @@ def get_mimic_user(target_room):
     return utils.fetchone_single(
         utils.get_db_conn().execute('SELECT mimic_user FROM rooms WHERE room_id=?', (target_room,)))
 
-def is_control_room(room_id):
-    return utils.fetchone_single(
-        utils.get_db_conn().execute('SELECT 1 FROM control_rooms WHERE room_id=?', (room_id,))) != None
-
-def get_control_room_user(room_id):
-    return utils.fetchone_single(
-        utils.get_db_conn().execute('SELECT mxid FROM control_rooms WHERE room_id=?', (room_id,)))
-
 
 def get_mimic_info_for_room_and_sender(room_id, sender):
-    mimic_user = None
-    access_token = None
-
-    c = utils.get_db_conn().cursor()
-    c.execute('SELECT mimic_user, access_token FROM rooms JOIN control_rooms ON rooms.mimic_user=control_rooms.mxid WHERE rooms.room_id=?', (room_id,))
-    row = c.fetchone()
-    if row != None:
-        mimic_user, access_token = row
-        if mimic_user == sender:
-            # Never replay the mimic user's own messages
-            mimic_user = None
-
-        if mimic_user != None and access_token != None and is_user_blacklisted(sender, mimic_user, room_id):
-            mimic_user = None
-
-    return mimic_user, access_token
+    route = routing.get_relay(room_id, sender)
+    if route == None:
+        return None, None
+    return route.mimic_user, route.access_token
 
 
 def control_room_notify(user_to, target_room_info, notify_fn, *args):
@@ -184,62 +253,50 @@ def control_room_notify(user_to, target_room_info, notify_fn, *args):
         return True
 
     if target_room_info.id != control_room:
-        # TODO non-blocking
-        return command_notify(control_room, target_room_info, True, notify_fn, *args)
-    else:
-        return True
+        # Don't block the transaction on this: the notice is sent once the current event is committed
+        message, reply_link = notify_fn(target_room_info, *args)
+        outbox.enqueue(control_room, target_room_info.id, True, reply_link, *message)
+
+    return True
 
 def command_notify(control_room, target_room_info, set_latest, notify_fn, *args):
     # Use this when the control room is known & a reply link is needed
-    r, reply_link = notify_fn(control_room, target_room_info, *args)
-    if r != None and r.status_code == 200:
+    message, reply_link = notify_fn(target_room_info, *args)
+    r = post_message(control_room, *message)
+    if r.status_code == 200:
         if reply_link:
-            event_id = r.json()['event_id']
-            c = utils.get_db_conn().cursor()
-            c.execute('INSERT INTO reply_links VALUES (?, ?, ?)',
-                (control_room, event_id, target_room_info.id))
-            if set_latest:
-                c.execute('INSERT INTO latest_reply_link VALUES (?, ?)',
-                    (control_room, event_id))
+            insert_reply_link(control_room, r.json()['event_id'], target_room_info.id, set_latest)
         return True
     else:
         return False
 
-def notify_bot_joined(control_room, target_room_info):
-    return post_message(control_room,
-        *messages.bot_joined(target_room_info)), True
+def notify_bot_joined(target_room_info):
+    return messages.bot_joined(target_room_info), True
 
-def notify_user_joined(control_room, target_room_info):
+def notify_user_joined(target_room_info):
     mimic_user = get_mimic_user(target_room_info.id)
-    return post_message(control_room,
-        *messages.user_joined(target_room_info, MxUserLink(mimic_user))), True
+    return messages.user_joined(target_room_info, MxUserLink(mimic_user)), True
 
-def notify_bot_left(control_room, target_room_info):
-    return post_message(control_room,
-        *messages.bot_left(target_room_info)), False
+def notify_bot_left(target_room_info):
+    return messages.bot_left(target_room_info), False
 
-def notify_accepted_mimic(control_room, target_room_info):
-    return post_message(control_room,
-        *messages.accepted_mimic(target_room_info)), True
+def notify_accepted_mimic(target_room_info):
+    return messages.accepted_mimic(target_room_info), True
 
-def notify_mimic_taken(control_room, target_room_info, mimic_user_info):
-    return post_message(control_room,
-        *messages.mimic_taken(target_room_info, mimic_user_info)), True
+def notify_mimic_taken(target_room_info, mimic_user_info):
+    return messages.mimic_taken(target_room_info, mimic_user_info), True
 
-def notify_mimic_user_left(control_room, target_room_info, mimic_user_info):
-    return post_message(control_room,
-        *messages.mimic_user_left(target_room_info, mimic_user_info)), True
+def notify_mimic_user_left(target_room_info, mimic_user_info):
+    return messages.mimic_user_left(target_room_info, mimic_user_info), True
 
-def notify_room_name(control_room, target_room_info):
-    return post_message(control_room,
-        *messages.room_name(target_room_info)), True
+def notify_room_name(target_room_info):
+    return messages.room_name(target_room_info), True
 
-def notify_room_name_and_mimic_user(control_room, target_room_info, mimic_user_info):
-    return post_message(control_room,
-        *messages.room_name_and_mimic_user(target_room_info, mimic_user_info)), True
+def notify_room_name_and_mimic_user(target_room_info, mimic_user_info):
+    return messages.room_name_and_mimic_user(target_room_info, mimic_user_info), True
 
-def notify_expired_token(control_room, target_room_info):
-    return post_message(control_room, messages.expired_token()), False
+def notify_expired_token(target_room_info):
+    return (messages.expired_token(),), False
 
 
 # TODO move all this to its own file once I think of a good way to remove circular deps
@@ -301,6 +358,7 @@ def cmd_register_token(command_args, sender, control_room):
     r = mx_request('GET', '/_matrix/client/r0/account/whoami', access_token=access_token)
     if r.status_code == 200 and r.json()['user_id'] == sender:
         utils.get_db_conn().execute('UPDATE control_rooms SET access_token=? WHERE mxid=?', (access_token, sender))
+        routing.invalidate(mimic_user=sender)
         return post_message_status(control_room, messages.received_token())
     else:
         return post_message_status(control_room, messages.invalid_token())
@@ -308,6 +366,7 @@ def cmd_register_token(command_args, sender, control_room):
 def cmd_revoke_token(command_args, sender, control_room):
     unmimic_user(sender)
     c = utils.get_db_conn().execute('UPDATE control_rooms SET access_token=NULL WHERE mxid=?', (sender,))
+    routing.invalidate(mimic_user=sender)
     return post_message_status(control_room,
         messages.revoked_token() if c.rowcount == 1 else messages.no_revoke_token())
 
@@ -327,6 +386,7 @@ def cmd_set_mimic_user(command_args, sender, control_room, target_room_info):
             return post_message_status(control_room, *messages.rejected_mimic(target_room_info, MxUserLink(mimic_user)))
         else:
             c.execute('UPDATE rooms SET mimic_user=? WHERE room_id=?', (sender, target_room_info.id))
+            routing.invalidate(target_room_info.id)
             event_success = command_notify(
                 control_room, target_room_info, True,
                 notify_accepted_mimic)
@@ -351,6 +411,8 @@ def cmd_unset_user(command_args, sender, control_room, target_room_info):
     c = utils.get_db_conn().cursor()
     c.execute('UPDATE rooms SET mimic_user=NULL WHERE mimic_user=? AND room_id=?', (sender, target_room_info.id))
     if c.rowcount != 0:
+        digest.discard(target_room_info.id)
+        routing.invalidate(target_room_info.id)
         event_success = post_message_status(control_room, *messages.stopped_mimic(target_room_info))
 
         # Notify other users that they can be mimic targets
@@ -374,12 +436,16 @@ def cmd_set_mode(command_args, sender, control_room, target_room_info):
         return post_message_status(control_room, messages.invalid_mode())
 
     c = utils.get_db_conn().cursor()
+    # A global change affects all rooms without a room-specific mode
+    routing.invalidate(mimic_user=sender)
 
     mode = command_args[0]
     if mode == 'default' and target_room_info != None:
         c.execute('DELETE FROM response_modes WHERE mimic_user=? AND room_id=?', (sender, target_room_info.id))
         mfunc = messages.default_response_mode_in_room if c.rowcount != 0 else messages.same_default_response_mode_in_room
         return post_message_status(control_room, *mfunc(target_room_info))
+    elif mode == 'digest' or mode == 'nodigest':
+        return set_digest_mode(c, sender, control_room, target_room_info, mode == 'digest')
     elif mode == 'echo':
         replace = 0
     elif mode == 'replace':
@@ -390,10 +456,10 @@ def cmd_set_mode(command_args, sender, control_room, target_room_info):
     noop = False
     if target_room_info == None:
         if replace:
-            try:
+            c.execute('SELECT 1 FROM response_modes WHERE mimic_user=? AND room_id is NULL', (sender,))
+            noop = utils.fetchone_single(c) != None
+            if not noop:
                 c.execute('INSERT INTO response_modes VALUES (?,NULL,1)', (sender,))
-            except IntegrityError:
-                noop = True
         else:
             c.execute('DELETE FROM response_modes WHERE mimic_user=? AND room_id is NULL', (sender,))
             noop = c.rowcount == 0
@@ -414,6 +480,24 @@ def cmd_set_mode(command_args, sender, control_room, target_room_info):
         mfunc = messages.set_response_mode_in_room if not noop else messages.same_response_mode_in_room
         return post_message_status(control_room, *mfunc(replace, target_room_info))
 
+def set_digest_mode(c, sender, control_room, target_room_info, enable):
+    if target_room_info == None:
+        return post_message_status(control_room, messages.digest_mode_needs_room())
+
+    c.execute('SELECT enabled FROM digest_rooms WHERE mimic_user=? AND room_id=?', (sender, target_room_info.id))
+    enabled = utils.fetchone_single(c)
+    noop = enabled == enable or (enabled == None and not enable)
+    if not noop:
+        if enable:
+            utils.upsert(c, 'digest_rooms', {'mimic_user': sender, 'room_id': target_room_info.id, 'enabled': 1},
+                key=('mimic_user', 'room_id'), update={'enabled': 1})
+        else:
+            # Buffering goes on until the buffer is sent, to keep relays in order
+            digest.end_digest_mode(sender, target_room_info.id)
+
+    mfunc = messages.set_digest_mode_in_room if not noop else messages.same_digest_mode_in_room
+    return post_message_status(control_room, *mfunc(enable, target_room_info))
+
 def cmd_set_blacklist(command_args, sender, control_room, target_room_info):
     if len(command_args) < 1:
         return post_message_status(control_room, messages.empty_blacklist())
@@ -424,6 +508,7 @@ def cmd_set_blacklist(command_args, sender, control_room, target_room_info):
     blacklist = ' '.join(command_args)
     if blacklist == 'default' and target_room_info != None:
         c.execute('DELETE FROM blacklists WHERE mimic_user=? AND room_id=?', (sender, target_room_info.id))
+        blacklists.invalidate(sender, target_room_info.id)
         mfunc = messages.default_blacklist_in_room if c.rowcount != 0 else messages.same_default_blacklist_in_room
         return post_message_status(control_room, *mfunc(target_room_info))
     elif blacklist == 'none':
@@ -434,6 +519,8 @@ def cmd_set_blacklist(command_args, sender, control_room, target_room_info):
         c.execute('DELETE FROM blacklists WHERE mimic_user=? AND room_id is NULL', (sender,))
     else:
         c.execute('INSERT INTO blacklists VALUES (?,?,?)', (sender, target_room_info.id if target_room_info != None else None, blacklist))
+    # A global change affects all rooms without a room-specific blacklist
+    blacklists.invalidate(sender, target_room_info.id if target_room_info != None else None)
 
     if target_room_info == None:
         return post_message_status(control_room, messages.set_blacklist())
@@ -441,12 +528,14 @@ def cmd_set_blacklist(command_args, sender, control_room, target_room_info):
         return post_message_status(control_room, *messages.set_blacklist_in_room(target_room_info))
 
 def cmd_get_blacklist(command_args, sender, control_room, target_room_info):
-    query = 'SELECT blacklist FROM blacklists WHERE mimic_user=? AND room_id IS ?'
     c = utils.get_db_conn().cursor()
-    c.execute(query, (sender, target_room_info.id if target_room_info else None))
+    if target_room_info != None:
+        c.execute('SELECT blacklist FROM blacklists WHERE mimic_user=? AND room_id=?', (sender, target_room_info.id))
+    else:
+        c.execute('SELECT blacklist FROM blacklists WHERE mimic_user=? AND room_id IS NULL', (sender,))
     row = c.fetchone()
     if target_room_info != None and row == None:
-        c.execute(query, (sender, None))
+        c.execute('SELECT blacklist FROM blacklists WHERE mimic_user=? AND room_id IS NULL', (sender,))
         default_blacklist = utils.fetchone_single(c)
         if default_blacklist == None:
             default_blacklist = 'no blacklist'
@@ -466,17 +555,16 @@ def cmd_show_status(command_args, sender, control_room):
         room_id = row[0]
         mimic_room_infos.append(MxRoomLink(room_id))
 
-    sender_rooms = get_rooms_for_user(sender)
-    placeholders = get_placeholders_for_room_list(sender_rooms)
-
     # TODO distinguish between echo and replace
+    # Monitored rooms are seeded with their members when the bot joins them (or at startup),
+    # so the user's rooms can be read off of the membership mirror.
     monitored_room_infos = []
-    for row in c.execute(f'SELECT room_id, mimic_user FROM rooms WHERE room_id IN ({placeholders}) ' \
-            f'AND mimic_user IS NOT NULL ' \
-            f'AND mimic_user IS NOT ?', (*sender_rooms, sender)):
-        room_id, mimic_user = row
-        if not is_user_blacklisted(sender, mimic_user, room_id):
-            monitored_room_infos.append((MxRoomLink(room_id), MxUserLink(mimic_user)))
+    c.execute('SELECT room_id, mimic_user FROM room_members JOIN rooms USING (room_id) ' \
+            'WHERE room_members.mxid=? ' \
+            'AND mimic_user IS NOT NULL ' \
+            'AND mimic_user!=?', (sender, sender))
+    for room_id, mimic_user in blacklists.get_unblacklisted_rooms(sender, c.fetchall()):
+        monitored_room_infos.append((MxRoomLink(room_id), MxUserLink(mimic_user)))
 
     if len(mimic_room_infos) == 0:
         if not post_message_status(control_room, messages.mimic_none()):
@@ -505,11 +593,9 @@ def cmd_show_actions(command_args, sender, control_room):
     # Don't quick-reply to anything after this
     c.execute('DELETE FROM latest_reply_link WHERE control_room=?', (control_room,))
 
-    sender_rooms = get_rooms_for_user(sender)
-    placeholders = get_placeholders_for_room_list(sender_rooms)
-
     mimic_room_infos = []
-    for row in c.execute(f'SELECT room_id FROM rooms WHERE room_id IN ({placeholders}) AND mimic_user IS NULL', sender_rooms):
+    for row in c.execute('SELECT room_id FROM room_members JOIN rooms USING (room_id) ' \
+            'WHERE room_members.mxid=? AND mimic_user IS NULL', (sender,)):
         room_id = row[0]
         mimic_room_infos.append(MxRoomLink(room_id))
 
@@ -539,7 +625,7 @@ COMMANDS = {
     'revoke':       Command(cmd_revoke_token, None, messages.cmd_revoke),
     'mimicme':      Command(cmd_set_mimic_user, '[room_alias_or_id]', messages.cmd_mimicme, True),
     'stopit':       Command(cmd_unset_user, '[room_alias_or_id]', messages.cmd_stopit, True),
-    'setmode':      Command(cmd_set_mode, '[room_alias_or_id] echo|replace|default', messages.cmd_setmode),
+    'setmode':      Command(cmd_set_mode, '[room_alias_or_id] echo|replace|default|digest|nodigest', messages.cmd_setmode),
     'blacklist':    Command(cmd_set_blacklist, '[room_alias_or_id] <user-id-patterns>', messages.cmd_blacklist),
     'getblacklist': Command(cmd_get_blacklist, '[room_alias_or_id]', messages.cmd_getblacklist),
     'status':       Command(cmd_show_status, None, messages.cmd_status),
@@ -561,13 +647,16 @@ def user_leave_room(member, room_left):
         # User was mimic target: remove all room-specific rules for the room
         c.execute('DELETE FROM response_modes WHERE mimic_user=? AND room_id=?', (member, room_left))
         c.execute('DELETE FROM blacklists WHERE mimic_user=? AND room_id=?', (member, room_left))
+        c.execute('DELETE FROM digest_rooms WHERE mimic_user=? AND room_id=?', (member, room_left))
+        digest.discard(room_left)
+        routing.invalidate(room_left)
+        blacklists.invalidate(member, room_left)
 
         room_users = get_listening_room_users(room_left, [config.as_botname, member])
         if room_users != None:
             room_left_info = MxRoomLink(room_left)
             member_info = MxUserLink(member)
             for room_member in room_users:
-                # TODO non-blocking? Success gating or not? Do the same for other occurrences of this pattern.
                 event_success = control_room_notify(
                     room_member, room_left_info,
                     notify_mimic_user_left, member_info) and event_success
@@ -596,313 +685,352 @@ def prepend_with_author(message, sender_info, isHTML):
 
     return '{0} says:{2}{1}'.format(author, message, linebreak*2)
 
+def relay_message(route, room_id, event_id, sender, content):
+    # Reposts a message as the room's mimic user, and returns the response.
+    # If it was sent, it is recorded as generated, and the original is queued to be redacted in replace mode.
+    sender_info = MxUserLink(sender)
 
-@app.route('/transactions/<int:txnId>', methods=['PUT'])
-def transactions(txnId):
-    response = validate_hs_token(request.args)
-    if response is not None:
-        return response
+    content['formatted_body'] = prepend_with_author(
+        content['formatted_body' if 'formatted_body' in content else 'body'], sender_info, True)
 
-    # Assume success until failure
-    txn_success = True
+    content['body'] = prepend_with_author(
+        content['body'], sender_info, False)
 
-    committed_event_idxs = get_committed_txn_event_idxs(txnId)
-    events = request.get_json()['events']
-    seen_event_ids = {}
-    for i in range(len(events)):
+    content['format'] = 'org.matrix.custom.html'
 
-        if len(committed_event_idxs) > 0 and i == committed_event_idxs[0]:
-            committed_event_idxs.pop(0)
-            continue
+    r = mx_request('PUT',
+            f'/_matrix/client/r0/rooms/{room_id}/send/m.room.message/txnId',
+            json=content,
+            access_token=route.access_token)
 
-        # Assume success until failure
-        event_success = True
+    if r.status_code == 200:
+        dedupe.record(r.json()['event_id'], room_id)
+        metrics.relays.inc()
 
-        event = events[i]
-        event_id = event['event_id']
-        seen_event_id = event_id
-        room_id = event.get('room_id')
-        content = event['content']
-        type = event['type']
+        if route.replace:
+            # Sent once this event is committed, and retried without failing it
+            outbox.enqueue_redaction(room_id, event_id)
 
-        print('\n---BEGIN EVENT')
-        print('type: ' + type)
-        for key in event:
-            if key != 'type':
-                print(f'{key}: {event[key]}')
-        print('--- END  EVENT')
+    return r
 
-        if type.find('m.room') == 0:
-            stype = type[7:]
-            sender = event['sender']
 
-            c = utils.get_db_conn().cursor()
+def handle_event(event):
+    # Assume success until failure
+    event_success = True
 
-            if stype == 'member':
-                member = event['state_key']
-                membership = content['membership']
-
-                # TODO map of memberships to functions
-
-                if membership == 'invite':
-                    if member == config.as_botname:
-                        refused = False
-                        if content.get('is_direct'):
-                            # Only accept 1:1 invites if bot doesn't already have a control room for the inviter.
-                            # TODO Does this need to handle invites to existing "direct" rooms with >1 people in them already...?
-                            control_room = find_existing_control_room(sender)
-
-                            if control_room != None:
-                                refused = True
-                                # Don't try to get the room name, because bot may not have access to it!
-                                if post_message_status(control_room, messages.already_controlled()):
-                                    event_success = bot_leave_room(room_id)
-                            else:
-                                insert_control_room(sender, room_id)
+    event_id = event['event_id']
+    seen_event_id = event_id
+    room_id = event.get('room_id')
+    content = event['content']
+    type = event['type']
 
-                        else:
-                            # Always accept group chat invites.
-                            # Since the bot was interacted with, create a control room for the sender.
-                            c.execute('INSERT INTO rooms VALUES (?, NULL)', (room_id,))
-                            event_success = find_or_prepare_control_room(sender) != None
-
-                        if event_success and not refused:
-                            # TODO non-blocking?
-                            r = mx_request('POST', f'/_matrix/client/r0/rooms/{room_id}/join')
-                            if r.status_code != 200:
-                                event_success = False
+    event_log.debug('event', extra=log.fields(event=event))
 
-                elif membership == 'join':
-                    if utils.get_from_dict(event, 'prev_content', 'membership') == 'join':
-                        # Do nothing if this is a repeat of a previous join event
-                        # If not in a control room, post message for a user changing their name
-                        if not is_control_room(room_id):
-                            mimic_user, access_token = get_mimic_info_for_room_and_sender(room_id, sender)
-                            if mimic_user != None and access_token != None:
-                                old_sender_name = utils.get_from_dict(event, 'prev_content', 'displayname')
-                                new_sender_name = utils.get_from_dict(event, 'content', 'displayname')
-                                # TODO Riot Web always renders pills with their current name, not with the text you give it...
-                                #old_sender_info = MxUserLink(sender, old_sender_name)
-                                new_sender_info = MxUserLink(sender, new_sender_name)
-                                event_success = post_message_status(
-                                    room_id,
-                                    *messages.user_renamed_msg(old_sender_name, new_sender_info),
-                                    access_token)
+    if type.find('m.room') == 0:
+        stype = type[7:]
+        sender = event['sender']
 
-                    else:
-                        in_control_room = is_control_room(room_id)
-                        if in_control_room == None:
-                            # Only possibility is that the bot somehow joined a room it didn't know about.
-                            # Just leave.
-                            event_success = bot_leave_room(room_id)
-
-                        elif in_control_room:
-                            if member == config.as_botname:
-                                # TODO non-blocking
-
-                                control_room_user = get_control_room_user(room_id)
-                                r = mx_request('GET', f'/_matrix/client/r0/rooms/{room_id}/joined_members')
-                                bot_created_room = r.json()['joined'] == [config.as_botname]
-                                if not bot_created_room:
-                                    mx_request('PUT',
-                                            f'/_matrix/client/r0/rooms/{room_id}/state/m.room.name',
-                                            json={'name': CONTROL_ROOM_NAME})
-
-                                # TODO Maybe don't send messages into this room until the user joins.
-                                #      For now just don't auto-run "actions" because joins will be shown
-                                event_success = \
-                                        post_message_status(room_id, messages.welcome())
-                                        #post_message_status(room_id, messages.welcome()) and \
-                                        #cmd_show_actions(None, get_control_room_user(room_id), room_id)
-                            else:
-                                # If someone other than the control room's user joined it,
-                                # send them a violation message.
-                                # Do nothing otherwise (don't need to respond to a user joining their control room).
-                                control_room_user = get_control_room_user(room_id)
-                                if member != control_room_user:
-                                    event_success = post_message_status(room_id,
-                                        *messages.invalid_control_room_user(MxUserLink(member), MxUserLink(control_room_user)))
+        c = utils.get_db_conn().cursor()
 
-                        else:
-                            if member == config.as_botname:
-                                # Notify each present listening user that the bot joined this room.
-                                room_users = get_listening_room_users(room_id, [config.as_botname])
-                                if room_users != None:
-                                    room_info = MxRoomLink(room_id)
-                                    for room_member in room_users:
-                                        event_success = control_room_notify(
-                                            room_member, room_info,
-                                            notify_bot_joined) and event_success
-                                else:
-                                    event_success = False
+        if stype == 'member':
+            member = event['state_key']
+            membership = content['membership']
 
-                            else:
-                                mimic_user, access_token = get_mimic_info_for_room_and_sender(room_id, sender)
-                                if mimic_user != None and access_token != None:
-                                    sender_info = MxUserLink(sender)
-                                    event_success = post_message_status(room_id, *messages.user_joined_msg(sender_info), access_token)
+            # Keep the membership mirror current before handling the event, so that handlers see the new state
+            update_room_member(room_id, member, membership)
+            invalidate_display_name(member)
 
-                                # Notify the user that they joined a room that the bot is in.
-                                event_success = control_room_notify(
-                                    member, MxRoomLink(room_id),
-                                    notify_user_joined) and event_success
+            # TODO map of memberships to functions
+
+            if membership == 'invite':
+                if member == config.as_botname:
+                    refused = False
+                    if content.get('is_direct'):
+                        # Only accept 1:1 invites if bot doesn't already have a control room for the inviter.
+                        # TODO Does this need to handle invites to existing "direct" rooms with >1 people in them already...?
+                        control_room = find_existing_control_room(sender)
+
+                        if control_room != None:
+                            refused = True
+                            # Don't try to get the room name, because bot may not have access to it!
+                            if post_message_status(control_room, messages.already_controlled()):
+                                event_success = bot_leave_room(room_id)
+                        else:
+                            insert_control_room(sender, room_id)
 
-                elif membership == 'leave':
+                    else:
+                        # Always accept group chat invites.
+                        # Since the bot was interacted with, create a control room for the sender.
+                        c.execute('INSERT INTO rooms (room_id) VALUES (?)', (room_id,))
+                        routing.invalidate(room_id)
+                        event_success = find_or_prepare_control_room(sender) != None
+
+                    if event_success and not refused:
+                        # TODO non-blocking?
+                        r = mx_request('POST', f'/_matrix/client/r0/rooms/{room_id}/join')
+                        if r.status_code != 200:
+                            event_success = False
+
+            elif membership == 'join':
+                if utils.get_from_dict(event, 'prev_content', 'membership') == 'join':
+                    # Do nothing if this is a repeat of a previous join event
+                    # If not in a control room, post message for a user changing their name
+                    if not is_control_room(room_id):
+                        mimic_user, access_token = get_mimic_info_for_room_and_sender(room_id, sender)
+                        if mimic_user != None and access_token != None:
+                            old_sender_name = utils.get_from_dict(event, 'prev_content', 'displayname')
+                            new_sender_name = utils.get_from_dict(event, 'content', 'displayname')
+                            # TODO Riot Web always renders pills with their current name, not with the text you give it...
+                            #old_sender_info = MxUserLink(sender, old_sender_name)
+                            new_sender_info = MxUserLink(sender, new_sender_name)
+                            event_success = post_message_status(
+                                room_id,
+                                *messages.user_renamed_msg(old_sender_name, new_sender_info),
+                                access_token)
+
+                else:
                     in_control_room = is_control_room(room_id)
-                    control_room_user = get_control_room_user(room_id) if in_control_room else None
                     if in_control_room == None:
-                        # Someone left an unmonitored room.
-                        # Ignore.
-                        pass
+                        # Only possibility is that the bot somehow joined a room it didn't know about.
+                        # Just leave.
+                        event_success = bot_leave_room(room_id)
 
-                    elif member == config.as_botname:
-                        if in_control_room:
-                            # Bot left a control room, so it should be shut down.
-                            # Act as if the monitored user left all rooms they were being mimicked in.
-                            event_success = unmimic_user(control_room_user)
+                    elif in_control_room:
+                        if member == config.as_botname:
+                            # TODO non-blocking
+
+                            control_room_user = get_control_room_user(room_id)
+                            r = mx_request('GET', f'/_matrix/client/r0/rooms/{room_id}/joined_members')
+                            bot_created_room = r.json()['joined'] == [config.as_botname]
+                            if not bot_created_room:
+                                mx_request('PUT',
+                                        f'/_matrix/client/r0/rooms/{room_id}/state/m.room.name',
+                                        json={'name': CONTROL_ROOM_NAME})
+
+                            # TODO Maybe don't send messages into this room until the user joins.
+                            #      For now just don't auto-run "actions" because joins will be shown
+                            event_success = \
+                                    post_message_status(room_id, messages.welcome())
+                                    #post_message_status(room_id, messages.welcome()) and \
+                                    #cmd_show_actions(None, get_control_room_user(room_id), room_id)
                         else:
-                            # For each listening user in room, say that bot left
+                            # If someone other than the control room's user joined it,
+                            # send them a violation message.
+                            # Do nothing otherwise (don't need to respond to a user joining their control room).
+                            control_room_user = get_control_room_user(room_id)
+                            if member != control_room_user:
+                                event_success = post_message_status(room_id,
+                                    *messages.invalid_control_room_user(MxUserLink(member), MxUserLink(control_room_user)))
+
+                    else:
+                        if member == config.as_botname:
+                            # Notify each present listening user that the bot joined this room.
                             room_users = get_listening_room_users(room_id, [config.as_botname])
                             if room_users != None:
                                 room_info = MxRoomLink(room_id)
                                 for room_member in room_users:
                                     event_success = control_room_notify(
                                         room_member, room_info,
-                                        notify_bot_left) and event_success
+                                        notify_bot_joined) and event_success
                             else:
                                 event_success = False
 
-                        # NOTE This should trigger a lot of cascaded deletions!
-                        c.execute(f'DELETE FROM {"rooms" if not in_control_room else "control_rooms"} WHERE room_id=?', (room_id,))
+                        else:
+                            mimic_user, access_token = get_mimic_info_for_room_and_sender(room_id, sender)
+                            if mimic_user != None and access_token != None:
+                                sender_info = MxUserLink(sender)
+                                event_success = post_message_status(room_id, *messages.user_joined_msg(sender_info), access_token)
+
+                            # Notify the user that they joined a room that the bot is in.
+                            event_success = control_room_notify(
+                                member, MxRoomLink(room_id),
+                                notify_user_joined) and event_success
+
+            elif membership == 'leave':
+                in_control_room = is_control_room(room_id)
+                control_room_user = get_control_room_user(room_id) if in_control_room else None
+                if in_control_room == None:
+                    # Someone left an unmonitored room.
+                    # Ignore.
+                    pass
 
+                elif member == config.as_botname:
+                    if in_control_room:
+                        # Bot left a control room, so it should be shut down.
+                        # Act as if the monitored user left all rooms they were being mimicked in.
+                        event_success = unmimic_user(control_room_user)
                     else:
-                        if in_control_room:
-                            if member == control_room_user:
-                                # User left their control room or rejected an invite.
-                                # Bot should leave the room too. Its leave event will handle the rest.
-                                event_success = bot_leave_room(room_id) and event_success
+                        # For each listening user in room, say that bot left
+                        room_users = get_listening_room_users(room_id, [config.as_botname])
+                        if room_users != None:
+                            room_info = MxRoomLink(room_id)
+                            for room_member in room_users:
+                                event_success = control_room_notify(
+                                    room_member, room_info,
+                                    notify_bot_left) and event_success
                         else:
-                            event_success = user_leave_room(member, room_id)
-
-                            # If no one else is in the room, the bot should leave.
-                            room_empty = False
-                            r = mx_request('GET', f'/_matrix/client/r0/rooms/{room_id}/joined_members')
-                            if r.status_code == 403:
-                                room_empty = True
-                            elif r.status_code == 200:
-                                # Look for just 1 user, which is the bot itself
-                                room_empty = len(r.json()['joined']) == 1
-                            else:
-                                event_success = False
-
-                            if event_success:
-                                if not room_empty:
-                                    # If the room is not empty, relay a message saying the user left.
-                                    mimic_user, access_token = get_mimic_info_for_room_and_sender(room_id, sender)
-                                    if mimic_user != None and access_token != None:
-                                        sender_info = MxUserLink(sender)
-                                        post_message(room_id, *messages.user_left_msg(sender_info), access_token)
-                                else:
-                                    event_success = bot_leave_room(room_id)
-
-
-
-            elif stype == 'message':
-                if 'body' not in content:
-                    # Event is redacted, ignore
-                    pass
-                elif is_control_room(room_id):
-                    if sender == get_control_room_user(room_id):
-                        replied_event = None
-                        try:
-                            replied_event = content['m.relates_to']['m.in_reply_to']['event_id']
-                            body = content['formatted_body']
-                            reply_end = body.find('</mx-reply>')
-                            body = body[reply_end+11:]
-                        except KeyError:
-                            body = content['body']
-
-                        event_success = run_command(body.split(), sender, room_id, replied_event)
-
-                elif sender != config.as_botname:
-
-                    # Create control room for a user who mentions the bot.
-                    if content['body'].find(config.as_botname) != -1 or \
-                            ('formatted_body' in content and content['formatted_body'].find(config.as_botname) != -1):
-                        control_room, is_new_room = find_or_prepare_control_room(sender)
-                        if control_room == None:
                             event_success = False
-                        elif not is_new_room:
-                            post_message(control_room, messages.ping())
 
+                    # NOTE This should trigger a lot of cascaded deletions!
+                    c.execute(f'DELETE FROM {"rooms" if not in_control_room else "control_rooms"} WHERE room_id=?', (room_id,))
+                    routing.invalidate(room_id, control_room_user)
+                    if not in_control_room:
+                        blacklists.invalidate(room_id=room_id)
                     else:
-                        mimic_user = None
-                        access_token = None
+                        blacklists.invalidate(mimic_user=control_room_user)
+
+                else:
+                    if in_control_room:
+                        if member == control_room_user:
+                            # User left their control room or rejected an invite.
+                            # Bot should leave the room too. Its leave event will handle the rest.
+                            event_success = bot_leave_room(room_id) and event_success
+                    else:
+                        event_success = user_leave_room(member, room_id)
+
+                        # If no one else is in the room, the bot should leave.
+                        room_empty = False
+                        room_members = get_room_members(room_id)
+                        if room_members != None:
+                            # Look for just 1 user, which is the bot itself
+                            room_empty = config.as_botname not in room_members or len(room_members) == 1
+                        else:
+                            event_success = False
 
-                        c.execute('SELECT 1 FROM generated_messages WHERE event_id=? AND room_id=?', (event_id, room_id))
-                        if c.fetchone() == None:
-                            mimic_user, access_token = get_mimic_info_for_room_and_sender(room_id, sender)
+                        if event_success:
+                            if not room_empty:
+                                # If the room is not empty, relay a message saying the user left.
+                                mimic_user, access_token = get_mimic_info_for_room_and_sender(room_id, sender)
+                                if mimic_user != None and access_token != None:
+                                    sender_info = MxUserLink(sender)
+                                    post_message(room_id, *messages.user_left_msg(sender_info), access_token)
+                            else:
+                                event_success = bot_leave_room(room_id)
+
+
+
+        elif stype == 'message':
+            if 'body' not in content:
+                # Event is redacted, ignore
+                pass
+            elif is_control_room(room_id):
+                if sender == get_control_room_user(room_id):
+                    replied_event = None
+                    try:
+                        replied_event = content['m.relates_to']['m.in_reply_to']['event_id']
+                        body = content['formatted_body']
+                        reply_end = body.find('</mx-reply>')
+                        body = body[reply_end+11:]
+                    except KeyError:
+                        body = content['body']
+
+                    event_success = run_command(body.split(), sender, room_id, replied_event)
+
+            elif sender != config.as_botname:
+
+                # Create control room for a user who mentions the bot.
+                if content['body'].find(config.as_botname) != -1 or \
+                        ('formatted_body' in content and content['formatted_body'].find(config.as_botname) != -1):
+                    control_room, is_new_room = find_or_prepare_control_room(sender)
+                    if control_room == None:
+                        event_success = False
+                    elif not is_new_room:
+                        post_message(control_room, messages.ping())
+
+                else:
+                    route = None
+                    if not dedupe.was_generated(event_id, room_id):
+                        route = routing.get_relay(room_id, sender)
+
+                    if route != None and route.digest and digest.buffer(route, room_id, event_id, sender, content):
+                        # Sent later, combined with others if it can be
+                        pass
 
-                        if mimic_user != None and access_token != None:
-                            sender_info = MxUserLink(sender)
+                    elif route != None:
+                        r = relay_message(route, room_id, event_id, sender, content)
 
-                            content['formatted_body'] = prepend_with_author(
-                                content['formatted_body' if 'formatted_body' in content else 'body'], sender_info, True)
+                        if r.status_code == 200:
+                            seen_event_id = r.json()['event_id']
+                        elif r.json()['errcode'] == 'M_UNKNOWN_TOKEN':
+                            event_success = control_room_notify(
+                                route.mimic_user, MxRoomLink(room_id),
+                                notify_expired_token)
+                        else:
+                            # Unknown token is a "valid" error. For anything else, want to retry
+                            event_success = False
 
-                            content['body'] = prepend_with_author(
-                                content['body'], sender_info, False)
+        elif stype == 'name' or stype == 'canonical_alias':
+            invalidate_room_name(room_id)
 
-                            content['format'] = 'org.matrix.custom.html'
+        else:
+            event_log.info('unsupported room event type', extra=log.fields(type=type, event_id=event_id))
+    else:
+        event_log.info('unsupported event type', extra=log.fields(type=type, event_id=event_id))
 
-                            r = mx_request('PUT',
-                                    f'/_matrix/client/r0/rooms/{room_id}/send/m.room.message/txnId',
-                                    json=content,
-                                    access_token=access_token)
+    return event_success, seen_event_id
 
-                            if r.status_code == 200:
-                                seen_event_id = r.json()['event_id']
-                                c.execute('INSERT INTO generated_messages VALUES (?, ?)', (seen_event_id, room_id))
 
-                                c.execute('SELECT replace FROM response_modes WHERE mimic_user=? AND room_id=?', (mimic_user, room_id))
-                                replace = utils.fetchone_single(c)
-                                if replace == None:
-                                    c.execute('SELECT replace FROM response_modes WHERE mimic_user=? AND room_id is NULL', (mimic_user,))
-                                    replace = utils.fetchone_single(c)
+def get_uncommitted_txn_events(txnId, events):
+    committed_event_idxs = get_committed_txn_event_idxs(txnId)
+    if committed_event_idxs == None:
+        return []
 
-                                if replace:
-                                    r = mx_request('PUT',
-                                        f'/_matrix/client/r0/rooms/{room_id}/redact/{event_id}/txnId',
-                                        json={'reason':'Replaced by ImposterBot'})
-                                    if r.status_code not in [200, 403, 404]:
-                                        event_success = False
-                                    elif r.status_code == 200:
-                                        seen_event_id = r.json()['event_id']
+    committed_event_idxs = set(committed_event_idxs)
+    return [(i, event) for i, event in enumerate(events) if i not in committed_event_idxs]
 
-                            elif r.json()['errcode'] == 'M_UNKNOWN_TOKEN':
-                                event_success = control_room_notify(
-                                    mimic_user, MxRoomLink(room_id),
-                                    notify_expired_token)
-                            else:
-                                # Unknown token is a "valid" error. For anything else, want to retry
-                                event_success = False
+def handle_txn_events(txnId, txn_events):
+    # Handles (index, event) pairs of a transaction in order, committing each event that succeeds.
+    # Assume success until failure
+    txn_success = True
 
-            else:
-                print(f'Unsupported room event type: {type}')
-        else:
-            print(f'Unsupported event type: {type}')
+    seen_event_ids = {}
+    for i, event in txn_events:
+        top_up_txnIds()
+        start = monotonic()
+        event_success, seen_event_id = handle_event(event)
+        event_labels = (event['type'], event['content'].get('membership', '') if event['type'] == 'm.room.member' else '')
+        metrics.events.inc(*event_labels)
+        metrics.event_seconds.observe(monotonic() - start, *event_labels)
 
+        room_id = event.get('room_id')
         if event_success:
             if room_id != None and not is_control_room(room_id):
                 seen_event_ids[room_id] = seen_event_id
             commit_txn_event(txnId, i)
         else:
-            print('\nEvent unsuccessful!!!!!')
+            metrics.failed_events.inc(*event_labels)
+            txn_log.warning('event unsuccessful', extra=log.fields(txnId=txnId, event_idx=i, event_id=event['event_id']))
             txn_success = False
             # Discard any uncommitted changes
             utils.close_db_conn()
 
-    for room_id, event_id in seen_event_ids.items():
-        # TODO non-blocking
-        mx_request('POST', f'/_matrix/client/r0/rooms/{room_id}/receipt/m.read/{event_id}')
+    return txn_success, seen_event_ids
+
+
+@app.route('/transactions/<int:txnId>', methods=['PUT'])
+def transactions(txnId):
+    response = validate_hs_token(request.args)
+    if response is not None:
+        return response
+
+    start = monotonic()
+    events = request.get_json()['events']
+    txn_events = get_uncommitted_txn_events(txnId, events)
+    if workers.pool != None:
+        txn_success, seen_event_ids = workers.handle_txn_events(txnId, txn_events)
+    else:
+        txn_success, seen_event_ids = handle_txn_events(txnId, txn_events)
+
+    receipts.update(seen_event_ids)
+
+    if txn_success:
+        ack_txn(txnId)
 
+    metrics.txn_events.observe(len(events))
+    metrics.txn_seconds.observe(monotonic() - start)
     return ({}, 200 if txn_success else 500)
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return metrics.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
@@ -112,7 +112,7 @@ def same_response_mode_in_room(replace, room_info):
     return get_link_fmt_pair('I was already {1} people\'s messages in {0}!', [room_info], 'echoing' if not replace else 'replacing')
 
 def invalid_mode():
-    return 'Valid modes are "echo", "replace", or "default" (only for room-specific modes).'
+    return 'Valid modes are "echo", "replace", or "default" (only for room-specific modes), and "digest" or "nodigest" (only for rooms).'
 
 def default_response_mode_in_room(room_info):
     return get_link_fmt_pair('I will now follow your global preference for how to handle people\'s messages in {}.{}', [room_info])
@@ -120,6 +120,15 @@ def default_response_mode_in_room(room_info):
 def same_default_response_mode_in_room(room_info):
     return get_link_fmt_pair('I was already following your global preference for how to handle people\'s messages in {}!', [room_info])
 
+def digest_mode_needs_room():
+    return 'Digest mode can only be set for a room, like "setmode <room> digest".'
+
+def set_digest_mode_in_room(digest, room_info):
+    return get_link_fmt_pair('I will now {1} in {0}.', [room_info], 'combine messages sent close together into one' if digest else 'repost each message on its own')
+
+def same_digest_mode_in_room(digest, room_info):
+    return get_link_fmt_pair('I was already {1} in {0}!', [room_info], 'combining messages sent close together' if digest else 'reposting each message on its own')
+
 def empty_blacklist():
     return 'Must provide a blacklist!'
 
@@ -170,7 +179,7 @@ cmd_token = 'Provides me with your Matrix account\'s access token, so that I may
 cmd_revoke = 'Makes me forget about any access token you gave me.'
 cmd_mimicme = 'Makes me use your account to repost other people\'s messages in the specified room. (If no room is provided, I\'ll use the most recent room I mentioned.)'
 cmd_stopit = 'Makes me stop mimicking you in the specified room. (If you don\'t specify a room, I\'ll use the most recent room I mentioned.)'
-cmd_setmode = 'Sets whether or not I delete people\'s messages when I repost them. This can have a different setting per room.'
+cmd_setmode = 'Sets whether or not I delete people\'s messages when I repost them. This can have a different setting per room. In a room, "digest" makes me combine messages sent close together into one repost, and "nodigest" stops that.'
 cmd_blacklist = 'Sets which accounts I will never repost messages for. The blacklist is one or more regex patterns; user IDs that match any pattern will be blacklisted. This can have a different setting per room.'
 cmd_getblacklist = 'Returns your global blacklist, or if a room is specified, your blacklist for that room.'
 cmd_status = 'Returns a list of all rooms I am mimicking you in, and all rooms I am reposting your messages in.'
@@ -1,105 +1,240 @@
 import atexit
+import json
 import signal
 import sys
-from threading import Timer
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from time import sleep
 
 import pkg_resources
-import sqlite3
 from flask import Flask
+from requests.exceptions import RequestException
 
 from . import config
+from . import dedupe
+from . import digest
+from . import log
+from . import outbox
+from . import receipts
+from . import scheduler
+from . import storage
 from . import utils
+from . import workers
 from .apputils import mx_request
 
+server_log = log.get('server')
+
 
 def run_sql(filename):
-    conn = sqlite3.connect(config.db_name)
+    conn = utils.get_thread_conn()
     c = conn.cursor()
     cmds = pkg_resources.resource_string(__name__, 'sql/' + filename).decode('utf8')
     for cmd in cmds.split(';\n\n'):
         c.execute(cmd)
     conn.commit()
-    conn.close()
 
 
+# Columns added to tables after they were first created, which db_prep.sql won't add to existing tables
+NEW_COLUMNS = [
+    ('generated_messages', 'sent_at', 'real NOT NULL DEFAULT 0'),
+    ('digest_buffer', 'content', 'text'),
+    ('digest_buffer', 'attempts', 'integer NOT NULL DEFAULT 0'),
+    ('txnId_blocks', 'committed_txnId', 'bigint NOT NULL DEFAULT 0'),
+    ('rooms', 'members_version', 'bigint NOT NULL DEFAULT 0'),
+]
+
+def add_new_columns():
+    conn = utils.get_thread_conn()
+    for table, column, decl in NEW_COLUMNS:
+        # Unquoted names are case-insensitive, and PostgreSQL reports them in lower case
+        columns = [name.lower() for name in storage.backend.get_columns(conn, table)]
+        if column.lower() not in columns:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
+    conn.commit()
+
+
+def get_profile_fingerprint():
+    profile = json.dumps([config.as_botname, config.as_disname, config.as_avatar])
+    return sha256(profile.encode()).hexdigest()
+
+def get_profile_field(field):
+    return mx_request('GET', f'/_matrix/client/r0/profile/{config.as_botname}/{field}', wait=True)
+
+def set_profile_field(field, value):
+    return mx_request('PUT', f'/_matrix/client/r0/profile/{config.as_botname}/{field}', wait=True,
+        json={field: value})
+
+def sync_profile():
+    # Registers the bot user if needed, and sets its profile to the configured one.
+    # Returns whether the profile is known to match.
+    profile = {'displayname': config.as_disname}
+    if config.as_avatar != '':
+        profile['avatar_url'] = config.as_avatar
+
+    with ThreadPoolExecutor(max_workers=len(profile)) as executor:
+        # Look the profile up once more after the last registration attempt, in case that one succeeded
+        for attempt in range(config.register_attempts + 1):
+            responses = dict(zip(profile, executor.map(get_profile_field, profile)))
+            if responses['displayname'].status_code != 404:
+                break
+            if attempt == config.register_attempts:
+                return False
+
+            # The bot user doesn't exist yet
+            r = mx_request('POST', '/_matrix/client/r0/register', wait=True,
+                json={
+                    'type': 'm.login.application_service',
+                    'username': config.as_botname[1:].split(':')[0]
+                })
+            if r.status_code != 200:
+                server_log.warning('failed to register bot user', extra=log.fields(status=r.status_code, attempts=attempt + 1))
+                sleep(utils.get_backoff(attempt))
+
+        outdated = [field for field, r in responses.items()
+            if r.status_code != 200 or utils.get_from_dict(r.json(), field) != profile[field]]
+        results = executor.map(lambda field: set_profile_field(field, profile[field]), outdated)
+        return all(r.status_code == 200 for r in results)
+
 def initial_setup():
     # TODO use alembic
-    run_sql('db_prep.sql')
-
-    # TODO non-blocking and error checking
-    r = mx_request('GET', f'/_matrix/client/r0/profile/{config.as_botname}/displayname', wait=True)
-    if r.status_code == 404:
-        r = mx_request('POST', '/_matrix/client/r0/register', wait=True,
-            json={
-                'type': 'm.login.application_service',
-                'username': config.as_botname[1:].split(':')[0]
-            })
-
-        if r.status_code == 200:
-            initial_setup()
-        else:
-            return
-
-    elif r.status_code != 200 or utils.get_from_dict(r.json(), 'displayname') != config.as_disname:
-        mx_request('PUT', f'/_matrix/client/r0/profile/{config.as_botname}/displayname', wait=True,
-            json={'displayname': config.as_disname})
-
-    if config.as_avatar == '':
+    run_sql(storage.backend.schema)
+    add_new_columns()
+    run_sql('db_indexes.sql')
+
+    # Skip talking to the homeserver if the profile was already set up as configured
+    conn = utils.get_thread_conn()
+    fingerprint = get_profile_fingerprint()
+    if utils.fetchone_single(conn.execute('SELECT fingerprint FROM bot_profile')) == fingerprint:
         return
-    r = mx_request('GET', f'/_matrix/client/r0/profile/{config.as_botname}/avatar_url', wait=True)
-    if r.status_code != 200 or utils.get_from_dict(r.json(), 'avatar_url') != config.as_avatar:
-        mx_request('PUT', f'/_matrix/client/r0/profile/{config.as_botname}/avatar_url', wait=True,
-            json={'avatar_url': config.as_avatar})
 
+    if sync_profile():
+        utils.upsert(conn, 'bot_profile', {'id': 0, 'fingerprint': fingerprint},
+            key=('id',), update={'fingerprint': 'excluded.fingerprint'})
+        conn.commit()
+
+
+def leave_room(room_id):
+    try:
+        mx_request('POST', f'/_matrix/client/r0/rooms/{room_id}/leave')
+    except RequestException as e:
+        server_log.warning('failed to leave unknown room', extra=log.fields(room_id=room_id, error=str(e)))
+
+def get_joined_members(room_id):
+    # Returns None if the members couldn't be found
+    try:
+        r = mx_request('GET', f'/_matrix/client/r0/rooms/{room_id}/joined_members')
+    except RequestException as e:
+        server_log.warning('failed to get room members', extra=log.fields(room_id=room_id, error=str(e)))
+        return None
+    return set(r.json()['joined']) if r.status_code == 200 else None
+
+def reconcile_rooms():
+    # Catch up with what may have changed while the bot was down:
+    # leave rooms the bot doesn't know about, and refresh the membership mirror of the rooms it does
+    # (seeding it for any that were never mirrored).
+    r = mx_request('GET', '/_matrix/client/r0/joined_rooms')
+    joined_rooms = set(r.json()['joined_rooms'])
 
-def leave_bad_rooms():
     app = Flask(__name__)
     with app.app_context():
-        c = utils.get_db_conn().cursor()
-        r = mx_request('GET', '/_matrix/client/r0/joined_rooms')
-        for room_id in r.json()['joined_rooms']:
-            c.execute('SELECT 1 FROM rooms WHERE room_id=?', (room_id,))
-            room_found = utils.fetchone_single(c)
-            if not room_found:
-                c.execute('SELECT 1 FROM control_rooms WHERE room_id=?', (room_id,))
-                room_found = utils.fetchone_single(c)
-
-            if not room_found:
-                mx_request('POST', f'/_matrix/client/r0/rooms/{room_id}/leave')
+        conn = utils.get_db_conn()
+        c = conn.cursor()
+        known_rooms = {row[0] for row in c.execute('SELECT room_id FROM rooms')}
+        known_rooms.update(row[0] for row in c.execute('SELECT room_id FROM control_rooms'))
+
+        # Only rooms whose members were already mirrored can have drifted
+        mirrored_rooms = {}
+        for room_id, mxid in c.execute('SELECT room_id, mxid FROM synced_rooms LEFT JOIN room_members USING (room_id)'):
+            members = mirrored_rooms.setdefault(room_id, set())
+            if mxid != None:
+                members.add(mxid)
+        unmirrored_rooms = {row[0] for row in c.execute('SELECT room_id FROM rooms WHERE room_id NOT IN (SELECT room_id FROM synced_rooms)')}
+        check_rooms = [room_id for room_id in list(mirrored_rooms) + list(unmirrored_rooms) if room_id in joined_rooms]
+
+        with ThreadPoolExecutor(max_workers=config.startup_workers) as executor:
+            for room_id in joined_rooms - known_rooms:
+                executor.submit(leave_room, room_id)
+            current_members = executor.map(get_joined_members, check_rooms)
+
+            drifted_rooms = 0
+            seeded_rooms = 0
+            for room_id, members in zip(check_rooms, current_members):
+                if members == None:
+                    continue
+                if room_id in unmirrored_rooms:
+                    seeded_rooms += 1
+                    c.execute('INSERT INTO synced_rooms VALUES (?)', (room_id,))
+                elif members != mirrored_rooms[room_id]:
+                    drifted_rooms += 1
+                else:
+                    continue
+                c.execute('DELETE FROM room_members WHERE room_id=?', (room_id,))
+                c.executemany('INSERT INTO room_members VALUES (?, ?)', [(room_id, mxid) for mxid in members])
+
+        conn.commit()
+        server_log.info('reconciled rooms', extra=log.fields(
+            joined=len(joined_rooms), left=len(joined_rooms - known_rooms), drifted=drifted_rooms, seeded=seeded_rooms))
 
 
-timer = None
 def update_presence():
-    mx_request('PUT', f'/_matrix/client/r0/presence/{config.as_botname}/status', wait=True,
-        json={'presence': 'online'}, verbose=False)
-
-    global timer
-    timer = Timer(20.0, update_presence)
-    timer.start()
+    try:
+        mx_request('PUT', f'/_matrix/client/r0/presence/{config.as_botname}/status',
+            json={'presence': 'online'}, verbose=False)
+    except RequestException:
+        # Requests fail when the homeserver is unreachable, but that must not stop the heartbeat
+        pass
 
 def sighandler(sig, frame):
-    print(f'Caught signal {sig}')
-
-    global timer
-    if timer != None:
-        timer.cancel()
-        sys.exit(0)
+    server_log.info('caught signal', extra=log.fields(signal=sig))
+    sys.exit(0)
 
 
 def on_exit():
-    print('Shutting down')
-    mx_request('PUT', f'/_matrix/client/r0/presence/{config.as_botname}/status',
-        json={'presence': 'offline'})
-
+    server_log.info('shutting down')
+    workers.stop()
+    scheduler.stop()
+    receipts.flush()
+    try:
+        mx_request('PUT', f'/_matrix/client/r0/presence/{config.as_botname}/status',
+            json={'presence': 'offline'})
+    except RequestException:
+        pass
+
+
+def start_scheduler(presence=True):
+    from .main import prune_acked_transactions, seed_unmirrored_rooms
+    if presence:
+        scheduler.add_job('presence', update_presence, config.presence_interval, delay=0)
+    scheduler.add_job('receipts', receipts.flush, config.receipt_interval)
+    scheduler.add_job('outbox_retry', outbox.retry_if_due, config.outbox_retry_interval)
+    # Often enough that buffered relays don't wait much longer than the window
+    scheduler.add_job('digest', digest.flush, config.digest_window / 4)
+    scheduler.add_job('prune_transactions', prune_acked_transactions, config.prune_interval)
+    scheduler.add_job('prune_generated_messages', dedupe.prune, config.prune_interval)
+    scheduler.add_job('seed_rooms', seed_unmirrored_rooms, config.seed_interval)
+    scheduler.start()
 
 def prep():
+    log.setup()
+    try:
+        storage.backend.claim()
+    except storage.DatabaseInUseError as e:
+        server_log.error('database in use', extra=log.fields(error=str(e)))
+        sys.exit(-1)
     initial_setup()
 
     # TODO is there any other missed state to sync?
-    leave_bad_rooms()
+    reconcile_rooms()
+
+    if config.workers > 0:
+        workers.start()
+
+    # Send any notices left over from the last run
+    outbox.wake()
+
+    start_scheduler()
 
     for sig in [signal.SIGINT, signal.SIGTERM, signal.SIGQUIT]:
         signal.signal(sig, sighandler)
-    update_presence()
 
     atexit.register(on_exit)
@@ -0,0 +1,118 @@
+import re
+from bisect import bisect_left
+from threading import Lock
+from urllib.parse import urlsplit
+
+# Counters and histograms served at /metrics in the Prometheus text format.
+# Updating one takes a lock and a dict lookup, so they stay on in production.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+registry = []
+
+
+def format_labels(names, values):
+    if len(names) == 0:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self._label_names = labels
+        self._values = {}
+        self._lock = Lock()
+        registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in self._values.items():
+                lines.append(f'{self.name}{format_labels(self._label_names, labels)} {value}')
+        return lines
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)):
+        self.name = name
+        self.help = help
+        self._label_names = labels
+        self._buckets = buckets
+        # Labels -> [count per bucket (the last one for +Inf), sum]
+        self._values = {}
+        self._lock = Lock()
+        registry.append(self)
+
+    def observe(self, value, *labels):
+        i = bisect_left(self._buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry == None:
+                entry = self._values[labels] = [[0] * (len(self._buckets) + 1), 0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        names = self._label_names + ('le',)
+        with self._lock:
+            for labels, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self._buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{format_labels(names, labels + (bound,))} {cumulative}')
+                lines.append(f'{self.name}_sum{format_labels(self._label_names, labels)} {total}')
+                lines.append(f'{self.name}_count{format_labels(self._label_names, labels)} {cumulative}')
+        return lines
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+# Room IDs, user IDs, event IDs, aliases & txnIds in a homeserver URL are replaced by a placeholder
+ID_SEGMENT = re.compile(r'/(?:[!@$#]|%21|%40|%24|%23)[^/]*|/\d+(?:\.\d+)?(?=/|$)')
+
+def endpoint_template(url):
+    return ID_SEGMENT.sub('/{id}', urlsplit(url).path)
+
+
+events = Counter('imposter_events_total',
+    'Events handled, by type and membership (for member events)', ('type', 'membership'))
+failed_events = Counter('imposter_events_failed_total',
+    'Events that failed to be handled, by type and membership (for member events)', ('type', 'membership'))
+event_seconds = Histogram('imposter_event_seconds',
+    'Time to handle an event, by type and membership (for member events)', ('type', 'membership'))
+
+txn_seconds = Histogram('imposter_transaction_seconds',
+    'Time to handle a transaction from the homeserver')
+txn_events = Histogram('imposter_transaction_events',
+    'Events per transaction from the homeserver', buckets=(1, 2, 5, 10, 20, 50, 100))
+
+hs_request_seconds = Histogram('imposter_hs_request_seconds',
+    'Latency of requests to the homeserver, by method and endpoint', ('method', 'endpoint'))
+hs_responses = Counter('imposter_hs_responses_total',
+    'Responses from the homeserver, by method, endpoint and status', ('method', 'endpoint', 'status'))
+hs_retries = Counter('imposter_hs_retries_total',
+    'Requests to the homeserver that were retried, by method and endpoint', ('method', 'endpoint'))
+hs_rejected = Counter('imposter_hs_rejected_total',
+    'Requests to the homeserver failed fast while its circuit was open, by method and endpoint', ('method', 'endpoint'))
+rate_limited = Counter('imposter_hs_rate_limited_total', 'Requests to the homeserver that were rate-limited')
+ratelimit_waits = Histogram('imposter_ratelimit_wait_seconds', 'Time requests were held back to avoid rate limits')
+job_seconds = Histogram('imposter_job_seconds', 'Time taken by runs of background jobs, by job', ('job',))
+job_failures = Counter('imposter_job_failures_total', 'Runs of background jobs that failed, by job', ('job',))
+
+relays = Counter('imposter_relays_total', 'Messages relayed by a mimic user')
+digests = Counter('imposter_digests_total', 'Combined messages relayed for rooms in digest mode')
+redactions = Counter('imposter_redactions_total', 'Relayed messages whose original was redacted')
+blacklist_hits = Counter('imposter_blacklist_hits_total', 'Messages not relayed because the sender was blacklisted')
@@ -0,0 +1,194 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from flask import g
+from requests.exceptions import RequestException
+
+from . import app
+from . import config
+from . import log
+from . import metrics
+from . import utils
+from .apputils import mx_request, post_message, insert_reply_link
+
+# Control room notices are written to the outbox table as part of the event that caused them,
+# and a pool of workers sends them after that event is committed.
+# Each control room is drained by at most one worker at a time, to keep its notices in order.
+#
+# Redactions of replaced messages are queued the same way in the pending_redactions table,
+# so that they neither hold up the next relay nor fail the transaction when they fail.
+# Each room's redactions are a queue of their own, but they don't depend on each other,
+# so one that must be retried doesn't hold up the rest.
+
+executor = None
+lock = Lock()
+# Kinds of queues
+NOTICES = 'notices'
+REDACTIONS = 'redactions'
+# (NOTICES, control room) or (REDACTIONS, room) -> whether it got more queued while being drained
+draining = {}
+# Whether notices are waiting to be retried
+retry_due = False
+# Worker processes leave sending notices to the front process, and just note that there are some to send
+send_here = True
+wake_requested = False
+
+outbox_log = log.get('outbox')
+
+
+def enqueue(control_room, target_room, set_latest, reply_link, message_plain, message_html=None):
+    utils.get_db_conn().execute('INSERT INTO outbox (control_room, target_room, set_latest, reply_link, message_plain, message_html) ' \
+        'VALUES (?, ?, ?, ?, ?, ?)',
+        (control_room, target_room, int(set_latest), int(reply_link), message_plain, message_html))
+    g.outbox_enqueued = True
+
+def enqueue_redaction(room_id, event_id):
+    utils.get_db_conn().execute('INSERT INTO pending_redactions (room_id, event_id) VALUES (?, ?)', (room_id, event_id))
+    g.outbox_enqueued = True
+
+def wake_if_enqueued():
+    # Call this after committing
+    global wake_requested
+    if g.pop('outbox_enqueued', False):
+        if send_here:
+            wake()
+        else:
+            wake_requested = True
+
+def wake():
+    global executor
+    with lock:
+        if executor == None:
+            executor = ThreadPoolExecutor(max_workers=config.outbox_workers, thread_name_prefix='outbox')
+        executor.submit(dispatch)
+
+
+def dispatch():
+    with app.app_context():
+        c = utils.get_db_conn().cursor()
+        queues = [(NOTICES, row[0]) for row in c.execute('SELECT DISTINCT control_room FROM outbox')]
+        queues += [(REDACTIONS, row[0]) for row in c.execute('SELECT DISTINCT room_id FROM pending_redactions')]
+
+    with lock:
+        for queue in queues:
+            if queue in draining:
+                draining[queue] = True
+            else:
+                draining[queue] = False
+                executor.submit(drain, queue)
+
+def drain(queue):
+    global retry_due
+    kind, room_id = queue
+    retry = False
+    try:
+        with app.app_context():
+            retry = not (send_pending(room_id) if kind == NOTICES else redact_pending(room_id))
+    except Exception as e:
+        outbox_log.exception('failed to send notices' if kind == NOTICES else 'failed to redact messages',
+            extra=log.fields(room_id=room_id))
+        retry = True
+
+    with lock:
+        if draining.pop(queue) and not retry:
+            # More came in after the last check for them
+            draining[queue] = False
+            executor.submit(drain, queue)
+
+    if retry:
+        retry_due = True
+
+def retry_if_due():
+    # Run periodically by the scheduler
+    global retry_due
+    if retry_due:
+        retry_due = False
+        wake()
+
+def send_pending(control_room):
+    # Returns False if a notice must be retried later
+    conn = utils.get_db_conn()
+    c = conn.cursor()
+    while True:
+        c.execute('SELECT id, target_room, set_latest, reply_link, message_plain, message_html, attempts FROM outbox ' \
+            'WHERE control_room=? ORDER BY id LIMIT 1', (control_room,))
+        row = c.fetchone()
+        if row == None:
+            return True
+
+        id, target_room, set_latest, reply_link, message_plain, message_html, attempts = row
+        if attempts >= config.outbox_max_attempts:
+            outbox_log.warning('dropping notice', extra=log.fields(id=id, control_room=control_room, attempts=attempts))
+            c.execute('DELETE FROM outbox WHERE id=?', (id,))
+            conn.commit()
+            continue
+
+        # Count the attempt before making it, so that however it fails (even after the notice went out),
+        # the notice isn't sent more than outbox_max_attempts times
+        c.execute('UPDATE outbox SET attempts=? WHERE id=?', (attempts + 1, id))
+        conn.commit()
+
+        try:
+            r = post_message(control_room, message_plain, message_html)
+            status_code = r.status_code
+        except RequestException:
+            status_code = None
+
+        if status_code == 200:
+            if reply_link:
+                insert_reply_link(control_room, r.json()['event_id'], target_room, set_latest)
+        elif status_code == None or status_code == 429 or status_code >= 500:
+            return False
+        else:
+            outbox_log.warning('dropping notice', extra=log.fields(id=id, control_room=control_room, status=status_code))
+
+        c.execute('DELETE FROM outbox WHERE id=?', (id,))
+        conn.commit()
+
+def redact_pending(room_id):
+    # Returns False if a redaction must be retried later
+    conn = utils.get_db_conn()
+    c = conn.cursor()
+    done = True
+    # Redactions left to be retried are skipped on this pass
+    last_id = -1
+    while True:
+        c.execute('SELECT id, event_id, attempts FROM pending_redactions WHERE room_id=? AND id>? ORDER BY id LIMIT 1',
+            (room_id, last_id))
+        row = c.fetchone()
+        if row == None:
+            return done
+
+        id, event_id, attempts = row
+        last_id = id
+        if attempts >= config.outbox_max_attempts:
+            outbox_log.warning('dropping redaction', extra=log.fields(id=id, room_id=room_id, event_id=event_id, attempts=attempts))
+            c.execute('DELETE FROM pending_redactions WHERE id=?', (id,))
+            conn.commit()
+            continue
+
+        # Counted before it's made, like notices are
+        c.execute('UPDATE pending_redactions SET attempts=? WHERE id=?', (attempts + 1, id))
+        conn.commit()
+
+        try:
+            r = mx_request('PUT',
+                f'/_matrix/client/r0/rooms/{room_id}/redact/{event_id}/txnId',
+                json={'reason':'Replaced by ImposterBot'})
+            status_code = r.status_code
+        except RequestException:
+            status_code = None
+
+        if status_code == 200:
+            metrics.redactions.inc()
+        elif status_code in [403, 404]:
+            # Without the power to redact, or with the message already gone, there's nothing to retry
+            pass
+        elif status_code == None or status_code == 429 or status_code >= 500:
+            done = False
+            continue
+        else:
+            outbox_log.warning('dropping redaction', extra=log.fields(id=id, room_id=room_id, event_id=event_id, status=status_code))
+
+        c.execute('DELETE FROM pending_redactions WHERE id=?', (id,))
+        conn.commit()
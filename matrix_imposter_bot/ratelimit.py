@@ -0,0 +1,121 @@
+from threading import Lock
+from time import monotonic, sleep
+
+from requests.exceptions import RequestException
+
+from . import config
+from . import log
+from . import metrics
+
+# Requests made with a user's access token (like relays with a mimic user's token) are paced by a
+# token bucket per access token, so that a busy room delays its relays instead of getting them rejected.
+# When the homeserver rate-limits a request anyway, that token's requests are held back for as long
+# as it says to, and its rate is lowered for a while.
+#
+# The bot's own token isn't paced (appservices are usually exempt from rate limits), but still backs off.
+
+ratelimit_log = log.get('request')
+
+
+class RateLimitedError(RequestException):
+    pass
+
+
+class TokenBucket:
+    """
+    Schedules requests at no more than `rate` per second, after a burst of up to `burst` of them.
+    A rate of None means no pacing, other than holding off after being rate-limited.
+    """
+    def __init__(self, rate, burst):
+        self._max_rate = rate
+        self._rate = rate
+        self._burst = burst
+        # When the next request could go out if the bucket were empty
+        self._next_at = 0
+        self._blocked_until = 0
+        self._queued = 0
+        self._lock = Lock()
+
+    def acquire(self):
+        # Blocks until a request may be sent, or raises RateLimitedError if it would wait too long
+        with self._lock:
+            now = monotonic()
+            if self._queued >= config.ratelimit_queue_size:
+                raise RateLimitedError('Too many requests are waiting for this access token')
+
+            send_at = max(now, self._blocked_until)
+            if self._rate != None:
+                interval = 1 / self._rate
+                next_at = max(self._next_at, now)
+                send_at = max(send_at, next_at - interval * (self._burst - 1))
+            if send_at - now > config.ratelimit_max_wait:
+                raise RateLimitedError(f'Requests for this access token are held back for {send_at - now:.1f} seconds')
+
+            if self._rate != None:
+                self._next_at = max(next_at, send_at) + interval
+            self._queued += 1
+
+        try:
+            if send_at > now:
+                metrics.ratelimit_waits.observe(send_at - now)
+                sleep(send_at - now)
+        finally:
+            with self._lock:
+                self._queued -= 1
+
+    def limited(self, retry_after):
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, monotonic() + retry_after)
+            if self._rate != None:
+                # Learn from being limited: halve the rate, then win it back slowly as requests succeed
+                self._rate = max(self._max_rate / 16, self._rate / 2)
+                self._next_at = max(self._next_at, self._blocked_until)
+
+    def succeeded(self):
+        with self._lock:
+            if self._rate != None and self._rate < self._max_rate:
+                self._rate = min(self._max_rate, self._rate + self._max_rate / 20)
+
+
+lock = Lock()
+# Access token -> TokenBucket
+buckets = {}
+
+def get_bucket(access_token):
+    with lock:
+        bucket = buckets.get(access_token)
+        if bucket == None:
+            if access_token == config.as_token:
+                bucket = TokenBucket(None, 1)
+            else:
+                bucket = TokenBucket(config.ratelimit_rate, config.ratelimit_burst)
+            buckets[access_token] = bucket
+    return bucket
+
+def get_retry_after(r):
+    try:
+        retry_after_ms = r.json().get('retry_after_ms')
+    except ValueError:
+        retry_after_ms = None
+    return retry_after_ms / 1000 if retry_after_ms != None else config.ratelimit_default_retry_after
+
+def send(access_token, send_fn):
+    # Makes a request with send_fn, pacing it and retrying it if it gets rate-limited
+    bucket = get_bucket(access_token)
+    attempt = 0
+    while True:
+        bucket.acquire()
+        r = send_fn()
+        if r.status_code != 429:
+            bucket.succeeded()
+            return r
+
+        attempt += 1
+        retry_after = get_retry_after(r)
+        bucket.limited(retry_after)
+        metrics.rate_limited.inc()
+        ratelimit_log.info('rate limited', extra=log.fields(
+            url=r.url, retry_after=retry_after, attempts=attempt))
+        if attempt >= config.ratelimit_attempts:
+            # Let the caller treat it like any other failure
+            return r
@@ -0,0 +1,37 @@
+from threading import Lock
+
+from requests.exceptions import RequestException
+
+from .apputils import mx_request
+
+# Read receipts are coalesced to the latest seen event of each room,
+# and sent by a scheduled job some time after the transaction that saw it was answered.
+
+lock = Lock()
+# Room ID -> latest seen event ID
+pending = {}
+
+
+def update(seen_event_ids):
+    with lock:
+        pending.update(seen_event_ids)
+
+def flush():
+    with lock:
+        to_send = dict(pending)
+        pending.clear()
+
+    failed = {}
+    for room_id, event_id in to_send.items():
+        try:
+            r = mx_request('POST', f'/_matrix/client/r0/rooms/{room_id}/receipt/m.read/{event_id}')
+            if r.status_code >= 500:
+                failed[room_id] = event_id
+        except RequestException:
+            failed[room_id] = event_id
+
+    if len(failed) != 0:
+        # Retry with the next flush, unless a newer event was seen in the meantime
+        with lock:
+            for room_id, event_id in failed.items():
+                pending.setdefault(room_id, event_id)
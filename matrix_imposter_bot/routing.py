@@ -0,0 +1,103 @@
+from collections import namedtuple, OrderedDict
+from threading import Lock
+
+from . import blacklists
+from . import config
+from . import metrics
+from . import utils
+
+# Everything needed to decide what to do with a room's messages is kept in memory,
+# so that relaying a message needs no DB reads.
+# Entries are loaded on first use, and dropped whenever the state behind them changes.
+# Only the most recently used cache_size rooms are kept.
+
+# control_room_user: owner of the room if it is a control room, else None
+# mimic_user, access_token: who relays the room's messages, if anyone (only users with a control room)
+# replace: the mimic user's response mode in effect for the room
+# digest: whether relays are buffered to be sent combined (also while digest mode is being turned off,
+#   until the buffer is empty, so that relays don't overtake buffered ones)
+Route = namedtuple('Route', ['control_room_user', 'mimic_user', 'access_token', 'replace', 'digest'])
+
+lock = Lock()
+# Room ID -> Route, least recently used first
+routes = OrderedDict()
+# Bumped whenever routes are dropped, so that a route loaded from before that isn't stored
+generation = 0
+
+
+def load_route(room_id):
+    c = utils.get_db_conn().cursor()
+
+    c.execute('SELECT mxid FROM control_rooms WHERE room_id=?', (room_id,))
+    control_room_user = utils.fetchone_single(c)
+    if control_room_user != None:
+        return Route(control_room_user, None, None, None, False)
+
+    c.execute('SELECT mimic_user, access_token FROM rooms JOIN control_rooms ON rooms.mimic_user=control_rooms.mxid WHERE rooms.room_id=?', (room_id,))
+    row = c.fetchone()
+    if row == None:
+        return Route(None, None, None, None, False)
+
+    mimic_user, access_token = row
+    # A room-specific response mode overrides the global one, which is stored with a NULL room ID
+    c.execute('SELECT replace FROM response_modes WHERE mimic_user=? AND (room_id=? OR room_id is NULL) ORDER BY room_id is NULL LIMIT 1',
+        (mimic_user, room_id))
+    replace = utils.fetchone_single(c)
+
+    c.execute('SELECT 1 FROM digest_rooms WHERE mimic_user=? AND room_id=?', (mimic_user, room_id))
+    return Route(None, mimic_user, access_token, replace, utils.fetchone_single(c) != None)
+
+def get_route(room_id):
+    with lock:
+        route = routes.get(room_id)
+        if route != None:
+            routes.move_to_end(room_id)
+        load_generation = generation
+    if route == None:
+        route = load_route(room_id)
+        with lock:
+            if generation == load_generation:
+                routes[room_id] = route
+                while len(routes) > config.cache_size:
+                    routes.popitem(last=False)
+    return route
+
+
+def is_control_room(room_id):
+    return get_route(room_id).control_room_user != None
+
+def get_control_room_user(room_id):
+    return get_route(room_id).control_room_user
+
+def get_relay(room_id, sender):
+    # Returns the route to relay a sender's message with, or None if it shouldn't be relayed
+    route = get_route(room_id)
+    if route.mimic_user == None or route.access_token == None:
+        return None
+    if route.mimic_user == sender:
+        # Never replay the mimic user's own messages
+        return None
+    if blacklists.is_blacklisted(sender, route.mimic_user, room_id):
+        metrics.blacklist_hits.inc()
+        return None
+    return route
+
+
+def drop_routes(room_id=None, mimic_user=None):
+    global generation
+    with lock:
+        generation += 1
+        if room_id == None and mimic_user == None:
+            routes.clear()
+            return
+
+        routes.pop(room_id, None)
+        if mimic_user != None:
+            for key, route in list(routes.items()):
+                if route.mimic_user == mimic_user or route.control_room_user == mimic_user:
+                    del routes[key]
+
+def invalidate(room_id=None, mimic_user=None):
+    # Call this when changing the rooms or control rooms tables, response modes, or digest rooms.
+    # Drops the route of room_id, and those of every room mimic_user relays or controls.
+    utils.invalidate(drop_routes, room_id, mimic_user)
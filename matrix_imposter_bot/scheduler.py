@@ -0,0 +1,78 @@
+from random import uniform
+from threading import Condition, Thread
+from time import monotonic
+
+from . import app
+from . import config
+from . import log
+from . import metrics
+
+# Periodic background jobs all run on one thread, one at a time, each in its own app context.
+# Intervals are jittered so that jobs don't keep lining up with each other.
+
+scheduler_log = log.get('server')
+
+
+class Job:
+    def __init__(self, name, fn, interval, delay):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.next_run = monotonic() + (delay if delay != None else self.jittered_interval())
+
+    def jittered_interval(self):
+        return self.interval * uniform(1 - config.job_jitter, 1 + config.job_jitter)
+
+    def run(self):
+        start = monotonic()
+        try:
+            with app.app_context():
+                self.fn()
+        except Exception:
+            metrics.job_failures.inc(self.name)
+            scheduler_log.exception('job failed', extra=log.fields(job=self.name))
+        finally:
+            metrics.job_seconds.observe(monotonic() - start, self.name)
+            self.next_run = monotonic() + self.jittered_interval()
+
+
+cond = Condition()
+# Name -> Job
+jobs = {}
+thread = None
+stopping = False
+
+
+def add_job(name, fn, interval, delay=None):
+    # Runs fn every interval seconds (give or take the jitter), first after delay seconds if given
+    with cond:
+        jobs[name] = Job(name, fn, interval, delay)
+        cond.notify()
+
+def run_loop():
+    while True:
+        with cond:
+            while True:
+                if stopping:
+                    return
+                job = min(jobs.values(), key=lambda job: job.next_run, default=None)
+                timeout = job.next_run - monotonic() if job != None else None
+                if timeout != None and timeout <= 0:
+                    break
+                cond.wait(timeout)
+
+        job.run()
+
+def start():
+    global thread
+    thread = Thread(target=run_loop, name='scheduler', daemon=True)
+    thread.start()
+
+def stop():
+    # Waits for a running job to finish, but doesn't start any more
+    global stopping
+    with cond:
+        stopping = True
+        cond.notify()
+    if thread != None:
+        thread.join()
@@ -0,0 +1,7 @@
+CREATE INDEX IF NOT EXISTS generated_messages_sent_at ON generated_messages (sent_at);
+
+CREATE INDEX IF NOT EXISTS digest_buffer_room_id ON digest_buffer (room_id, id);
+
+CREATE INDEX IF NOT EXISTS room_members_mxid ON room_members (mxid, room_id);
+
+CREATE INDEX IF NOT EXISTS pending_redactions_room_id ON pending_redactions (room_id, id);
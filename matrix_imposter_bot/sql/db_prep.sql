@@ -2,7 +2,9 @@ PRAGMA foreign_keys = ON;
 
 CREATE TABLE IF NOT EXISTS rooms (
     room_id text PRIMARY KEY,
-    mimic_user text
+    mimic_user text,
+    -- Bumped by every member event, so that a seed of room_members can tell if it raced one
+    members_version integer NOT NULL DEFAULT 0
 );
 
 CREATE TABLE IF NOT EXISTS control_rooms (
@@ -55,9 +57,28 @@ CREATE TRIGGER IF NOT EXISTS unique_null_blacklists
         DELETE FROM blacklists WHERE room_id IS NULL AND mimic_user=NEW.mimic_user;
     END;
 
+CREATE TABLE IF NOT EXISTS room_members (
+    room_id text NOT NULL,
+    mxid text NOT NULL,
+
+    PRIMARY KEY (room_id, mxid),
+    FOREIGN KEY (room_id)
+        REFERENCES rooms (room_id)
+        ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS synced_rooms (
+    room_id text PRIMARY KEY,
+
+    FOREIGN KEY (room_id)
+        REFERENCES rooms (room_id)
+        ON DELETE CASCADE
+);
+
 CREATE TABLE IF NOT EXISTS generated_messages (
     event_id text NOT NULL,
     room_id text NOT NULL,
+    sent_at real NOT NULL DEFAULT 0,
 
     PRIMARY KEY (event_id, room_id),
     FOREIGN KEY (room_id)
@@ -85,6 +106,29 @@ CREATE TABLE IF NOT EXISTS latest_reply_link (
         ON DELETE CASCADE
 );
 
+CREATE TABLE IF NOT EXISTS outbox (
+    id integer PRIMARY KEY AUTOINCREMENT,
+    control_room text NOT NULL,
+    target_room text NOT NULL,
+    set_latest integer CHECK (set_latest IN (0,1)),
+    reply_link integer CHECK (reply_link IN (0,1)),
+    message_plain text NOT NULL,
+    message_html text,
+    attempts integer NOT NULL DEFAULT 0,
+
+    FOREIGN KEY (control_room)
+        REFERENCES control_rooms (room_id)
+        ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS transactions_in_progress (
+    txnId integer NOT NULL,
+    chunk integer NOT NULL,
+    bitmap integer NOT NULL,
+
+    PRIMARY KEY (txnId, chunk)
+);
+
 CREATE TABLE IF NOT EXISTS transactions_in (
     txnId integer NOT NULL,
     event_idx integer NOT NULL,
@@ -92,8 +136,76 @@ CREATE TABLE IF NOT EXISTS transactions_in (
     PRIMARY KEY (txnId, event_idx)
 );
 
+INSERT OR IGNORE INTO transactions_in_progress
+    SELECT txnId, event_idx / 63, SUM(1 << (event_idx % 63)) FROM transactions_in GROUP BY txnId, event_idx / 63;
+
+DROP TABLE transactions_in;
+
+CREATE TABLE IF NOT EXISTS acked_transactions (
+    txnId integer PRIMARY KEY,
+    acked_at real NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS acked_transactions_acked_at ON acked_transactions (acked_at);
+
+CREATE TABLE IF NOT EXISTS txnId_blocks (
+    id integer PRIMARY KEY CHECK (id = 0),
+    next_txnId integer NOT NULL,
+    committed_txnId integer NOT NULL DEFAULT 0
+);
+
 CREATE TABLE IF NOT EXISTS transactions_out (
     txnId integer PRIMARY KEY AUTOINCREMENT,
     committed integer CHECK (committed IN (0,1))
 );
 
+INSERT OR IGNORE INTO txnId_blocks (id, next_txnId, committed_txnId)
+    SELECT 0, IFNULL(MAX(txnId), 0) + 1, IFNULL(MAX(CASE WHEN committed THEN txnId END), 0) FROM transactions_out;
+
+DROP TABLE transactions_out;
+
+CREATE TABLE IF NOT EXISTS bot_profile (
+    id integer PRIMARY KEY CHECK (id = 0),
+    fingerprint text NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS digest_rooms (
+    mimic_user text NOT NULL,
+    room_id text NOT NULL,
+    enabled integer NOT NULL CHECK (enabled IN (0,1)),
+
+    PRIMARY KEY (mimic_user, room_id),
+    FOREIGN KEY (mimic_user)
+        REFERENCES control_rooms (mxid)
+        ON DELETE CASCADE,
+    FOREIGN KEY (room_id)
+        REFERENCES rooms (room_id)
+        ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS digest_buffer (
+    id integer PRIMARY KEY AUTOINCREMENT,
+    room_id text NOT NULL,
+    event_id text NOT NULL,
+    sender text NOT NULL,
+    body text NOT NULL,
+    formatted_body text,
+    content text,
+    buffered_at real NOT NULL,
+    attempts integer NOT NULL DEFAULT 0,
+
+    FOREIGN KEY (room_id)
+        REFERENCES rooms (room_id)
+        ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS pending_redactions (
+    id integer PRIMARY KEY AUTOINCREMENT,
+    room_id text NOT NULL,
+    event_id text NOT NULL,
+    attempts integer NOT NULL DEFAULT 0,
+
+    FOREIGN KEY (room_id)
+        REFERENCES rooms (room_id)
+        ON DELETE CASCADE
+);
@@ -0,0 +1,190 @@
+SELECT pg_advisory_xact_lock(1229869908);
+
+CREATE TABLE IF NOT EXISTS rooms (
+    room_id text PRIMARY KEY,
+    mimic_user text,
+    -- Bumped by every member event, so that a seed of room_members can tell if it raced one
+    members_version bigint NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS control_rooms (
+    mxid text PRIMARY KEY,
+    room_id text NOT NULL UNIQUE,
+    access_token text
+);
+
+CREATE TABLE IF NOT EXISTS response_modes (
+    mimic_user text NOT NULL,
+    room_id text,
+    replace integer CHECK (replace IN (0,1)),
+
+    UNIQUE (mimic_user, room_id),
+    FOREIGN KEY (mimic_user)
+        REFERENCES control_rooms (mxid)
+        ON DELETE CASCADE,
+    FOREIGN KEY (room_id)
+        REFERENCES rooms (room_id)
+        ON DELETE CASCADE
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS unique_null_response_modes ON response_modes (mimic_user) WHERE room_id IS NULL;
+
+CREATE TABLE IF NOT EXISTS blacklists (
+    mimic_user text NOT NULL,
+    room_id text,
+    blacklist text,
+
+    UNIQUE (mimic_user, room_id),
+    FOREIGN KEY (mimic_user)
+        REFERENCES control_rooms (mxid)
+        ON DELETE CASCADE,
+    FOREIGN KEY (room_id)
+        REFERENCES rooms (room_id)
+        ON DELETE CASCADE
+);
+
+CREATE OR REPLACE FUNCTION replace_blacklist() RETURNS trigger AS $$
+    BEGIN
+        DELETE FROM blacklists WHERE mimic_user=NEW.mimic_user AND room_id IS NOT DISTINCT FROM NEW.room_id;
+        RETURN NEW;
+    END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS replace_blacklist ON blacklists;
+
+CREATE TRIGGER replace_blacklist
+    BEFORE INSERT ON blacklists
+    FOR EACH ROW EXECUTE FUNCTION replace_blacklist();
+
+CREATE TABLE IF NOT EXISTS room_members (
+    room_id text NOT NULL,
+    mxid text NOT NULL,
+
+    PRIMARY KEY (room_id, mxid),
+    FOREIGN KEY (room_id)
+        REFERENCES rooms (room_id)
+        ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS synced_rooms (
+    room_id text PRIMARY KEY,
+
+    FOREIGN KEY (room_id)
+        REFERENCES rooms (room_id)
+        ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS generated_messages (
+    event_id text NOT NULL,
+    room_id text NOT NULL,
+    sent_at double precision NOT NULL DEFAULT 0,
+
+    PRIMARY KEY (event_id, room_id),
+    FOREIGN KEY (room_id)
+        REFERENCES rooms (room_id)
+        ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS reply_links (
+    control_room text NOT NULL,
+    event_id text NOT NULL,
+    room_id text NOT NULL,
+
+    PRIMARY KEY (control_room, event_id),
+    FOREIGN KEY (control_room)
+        REFERENCES control_rooms (room_id)
+        ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS latest_reply_link (
+    control_room text PRIMARY KEY,
+    event_id text NOT NULL,
+
+    FOREIGN KEY (control_room, event_id)
+        REFERENCES reply_links (control_room, event_id)
+        ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS outbox (
+    id bigserial PRIMARY KEY,
+    control_room text NOT NULL,
+    target_room text NOT NULL,
+    set_latest integer CHECK (set_latest IN (0,1)),
+    reply_link integer CHECK (reply_link IN (0,1)),
+    message_plain text NOT NULL,
+    message_html text,
+    attempts integer NOT NULL DEFAULT 0,
+
+    FOREIGN KEY (control_room)
+        REFERENCES control_rooms (room_id)
+        ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS transactions_in_progress (
+    txnId bigint NOT NULL,
+    chunk integer NOT NULL,
+    bitmap bigint NOT NULL,
+
+    PRIMARY KEY (txnId, chunk)
+);
+
+CREATE TABLE IF NOT EXISTS acked_transactions (
+    txnId bigint PRIMARY KEY,
+    acked_at double precision NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS acked_transactions_acked_at ON acked_transactions (acked_at);
+
+CREATE TABLE IF NOT EXISTS txnId_blocks (
+    id integer PRIMARY KEY CHECK (id = 0),
+    next_txnId bigint NOT NULL,
+    committed_txnId bigint NOT NULL DEFAULT 0
+);
+
+INSERT INTO txnId_blocks (id, next_txnId) VALUES (0, 1) ON CONFLICT DO NOTHING;
+
+CREATE TABLE IF NOT EXISTS bot_profile (
+    id integer PRIMARY KEY CHECK (id = 0),
+    fingerprint text NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS digest_rooms (
+    mimic_user text NOT NULL,
+    room_id text NOT NULL,
+    enabled integer NOT NULL CHECK (enabled IN (0,1)),
+
+    PRIMARY KEY (mimic_user, room_id),
+    FOREIGN KEY (mimic_user)
+        REFERENCES control_rooms (mxid)
+        ON DELETE CASCADE,
+    FOREIGN KEY (room_id)
+        REFERENCES rooms (room_id)
+        ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS digest_buffer (
+    id bigserial PRIMARY KEY,
+    room_id text NOT NULL,
+    event_id text NOT NULL,
+    sender text NOT NULL,
+    body text NOT NULL,
+    formatted_body text,
+    content text,
+    buffered_at double precision NOT NULL,
+    attempts integer NOT NULL DEFAULT 0,
+
+    FOREIGN KEY (room_id)
+        REFERENCES rooms (room_id)
+        ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS pending_redactions (
+    id bigserial PRIMARY KEY,
+    room_id text NOT NULL,
+    event_id text NOT NULL,
+    attempts integer NOT NULL DEFAULT 0,
+
+    FOREIGN KEY (room_id)
+        REFERENCES rooms (room_id)
+        ON DELETE CASCADE
+);
@@ -0,0 +1,234 @@
+import re
+import sqlite3
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from threading import BoundedSemaphore, Lock, local
+
+from . import config
+
+# The database engine the bot keeps its state in: SQLite by default, or PostgreSQL.
+# Either way, only one bot process (along with its own worker processes) may use a database at a time,
+# since each process caches what it read from it, and drains the outbox and digest buffer on its own.
+# Storage.claim makes sure of that at startup.
+# Queries are written with ? placeholders, in SQL that both engines accept, and each engine hands out
+# connections that look like sqlite3 ones. What the engines write differently (like upserts) goes through Storage.
+
+
+class DatabaseInUseError(RuntimeError):
+    pass
+
+
+class Storage(ABC):
+    # Name of the file in sql/ that creates the tables
+    schema = None
+
+    def __init__(self):
+        # Each thread can keep a connection open, along with its cache of prepared statements
+        self._thread_conns = local()
+
+    @abstractmethod
+    def connect(self, shared=False):
+        # A new connection, which may be used by other threads than this one if shared
+        pass
+
+    def is_closed(self, conn):
+        # Whether the connection was lost, and must be replaced with a new one
+        return False
+
+    def get_thread_conn(self):
+        conn = getattr(self._thread_conns, 'conn', None)
+        if conn == None or self.is_closed(conn):
+            conn = self._thread_conns.conn = self.connect()
+        return conn
+
+    def acquire(self):
+        # A connection for one app context, to be given back with release
+        return self.get_thread_conn()
+
+    def release(self, conn):
+        # Do not commit here! Anything left uncommitted is discarded.
+        conn.rollback()
+
+    @abstractmethod
+    def get_columns(self, conn, table):
+        # Names of the table's columns, for migrations
+        pass
+
+    @abstractmethod
+    def claim(self):
+        # Keeps other bot processes from using the database for as long as this one runs,
+        # or raises DatabaseInUseError if another one already is
+        pass
+
+    def insert_sql(self, verb, table, row, where):
+        columns = ', '.join(row)
+        values = ', '.join('?' * len(row))
+        if where == None:
+            return f'{verb} INTO {table} ({columns}) VALUES ({values})'
+        return f'{verb} INTO {table} ({columns}) SELECT {values} WHERE {where}'
+
+    def upsert(self, conn, table, row, key=None, update=None, where=None, where_params=()):
+        # Inserts row (a dict of column values), if the where condition holds.
+        # If that conflicts with an existing row over the key columns, the existing row gets the update instead
+        # (a dict of column SQL expressions, in which excluded.<column> is the value that was to be inserted),
+        # or is left as it is without one.
+        sql = self.insert_sql('INSERT', table, row, where)
+        if update == None:
+            sql += ' ON CONFLICT DO NOTHING'
+        else:
+            sql += f' ON CONFLICT ({", ".join(key)}) DO UPDATE SET ' + ', '.join(f'{column}={expr}' for column, expr in update.items())
+        return conn.execute(sql, (*row.values(), *where_params))
+
+
+class SQLiteStorage(Storage):
+    schema = 'db_prep.sql'
+
+    def connect(self, shared=False):
+        conn = sqlite3.connect(config.db_name, timeout=config.db_busy_timeout,
+            cached_statements=config.db_statement_cache, check_same_thread=not shared)
+        # With WAL, readers and the writer don't block each other
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute(f'PRAGMA synchronous = {config.db_synchronous}')
+        conn.execute('PRAGMA foreign_keys = ON')
+        return conn
+
+    def get_columns(self, conn, table):
+        return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+    def claim(self):
+        # Held in a file next to the database until the process exits, and let go of by the OS if it crashes
+        import fcntl
+        self._claim_file = open(f'{config.db_name}.lock', 'w')
+        try:
+            fcntl.flock(self._claim_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise DatabaseInUseError(f'{config.db_name} is used by another bot process')
+
+    def upsert(self, conn, table, row, key=None, update=None, where=None, where_params=()):
+        if update != None:
+            return super().upsert(conn, table, row, key, update, where, where_params)
+        # SQLite's own way, which also works with versions older than upserts
+        return conn.execute(self.insert_sql('INSERT OR IGNORE', table, row, where), (*row.values(), *where_params))
+
+
+# A quoted string or identifier (where a doubled quote escapes it, and reads as two quoted parts), or a placeholder
+sql_token_pattern = re.compile(r"'[^']*'|\"[^\"]*\"|\?")
+
+@lru_cache(maxsize=config.db_statement_cache)
+def to_pyformat(sql):
+    # psycopg2 reads % as the start of a placeholder even within quotes, but ? within quotes is just text
+    return sql_token_pattern.sub(lambda m: '%s' if m.group() == '?' else m.group(), sql.replace('%', '%%'))
+
+class PostgresCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, sql, params=None):
+        # Without params, psycopg2 leaves % alone
+        self._cursor.execute(to_pyformat(sql) if params != None else sql, params)
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self._cursor.executemany(to_pyformat(sql), seq_of_params)
+        return self
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+class PostgresConnection:
+    def __init__(self, conn):
+        self.raw = conn
+
+    def cursor(self):
+        return PostgresCursor(self.raw.cursor())
+
+    def execute(self, sql, params=None):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def close(self):
+        self.raw.close()
+
+class PostgresStorage(Storage):
+    schema = 'db_prep_postgres.sql'
+
+    def __init__(self):
+        super().__init__()
+        import psycopg2.pool
+        self._psycopg2 = psycopg2
+        self._pool = None
+        self._pool_lock = Lock()
+        # The pool fails instead of waiting when it runs out, so wait here
+        self._pool_slots = BoundedSemaphore(config.db_pool_size)
+
+    def connect(self, shared=False):
+        # psycopg2 connections may be shared between threads anyway
+        return PostgresConnection(self._psycopg2.connect(config.db_dsn))
+
+    def get_pool(self):
+        # Made on first use, so that worker processes each make their own
+        with self._pool_lock:
+            if self._pool == None:
+                self._pool = self._psycopg2.pool.ThreadedConnectionPool(0, config.db_pool_size, config.db_dsn)
+            return self._pool
+
+    def acquire(self):
+        self._pool_slots.acquire()
+        try:
+            return PostgresConnection(self.get_pool().getconn())
+        except Exception:
+            self._pool_slots.release()
+            raise
+
+    def is_closed(self, conn):
+        return bool(conn.raw.closed)
+
+    def release(self, conn):
+        try:
+            if not self.is_closed(conn):
+                conn.rollback()
+        except self._psycopg2.Error:
+            pass
+        finally:
+            # Connections lost along with the server are replaced with new ones
+            self.get_pool().putconn(conn.raw, close=self.is_closed(conn))
+            self._pool_slots.release()
+
+    def get_columns(self, conn, table):
+        return [row[0] for row in conn.execute(
+            'SELECT column_name FROM information_schema.columns WHERE table_schema=current_schema() AND table_name=?', (table.lower(),))]
+
+    def claim(self):
+        # A session-level advisory lock, held by a connection of its own until the process exits.
+        # It is keyed by the schema, so that databases shared by schemas (like the benchmark's) can be claimed separately.
+        self._claim_conn = self.connect()
+        locked = self._claim_conn.execute('SELECT pg_try_advisory_lock(1229869908, hashtext(current_schema()))').fetchone()[0]
+        self._claim_conn.commit()
+        if not locked:
+            raise DatabaseInUseError('The database is used by another bot process')
+
+
+ENGINES = {
+    'sqlite': SQLiteStorage,
+    'postgres': PostgresStorage,
+}
+
+backend = ENGINES[config.db_engine]()
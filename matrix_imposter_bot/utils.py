@@ -1,18 +1,38 @@
-import sqlite3
+import logging
+from collections import OrderedDict
+from threading import Lock
 
 from flask import g
-from requests import request
-from requests.exceptions import ConnectionError
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
 
-from time import sleep
+from random import uniform
+from time import monotonic, sleep
+from urllib.parse import urlsplit
 
-from .config import db_name
+from . import log
+from . import metrics
+from . import storage
+from .config import hs_pool_size, hs_connect_timeout, hs_timeout, \
+    hs_retry_attempts, hs_retry_base_delay, hs_retry_max_delay, hs_circuit_threshold, hs_circuit_reset
 
 
+def connect(shared=False):
+    return storage.backend.connect(shared)
+
+def is_closed(conn):
+    return storage.backend.is_closed(conn)
+
+def get_thread_conn():
+    return storage.backend.get_thread_conn()
+
+def upsert(conn, table, row, **kwargs):
+    return storage.backend.upsert(conn, table, row, **kwargs)
+
 def get_db_conn():
     if 'conn' not in g:
-        g.conn = sqlite3.connect(db_name)
-        g.conn.execute('PRAGMA foreign_keys = ON')
+        g.conn = storage.backend.acquire()
 
     return g.conn
 
@@ -20,8 +40,32 @@ def close_db_conn():
     conn = g.pop('conn', None)
 
     if conn != None:
-        # Do not commit here! Other places should do it themselves
-        conn.close()
+        # Do not commit here! Other places should do it themselves.
+        storage.backend.release(conn)
+
+    settle_invalidations()
+
+
+# Set in worker processes, to hear of dropped cache entries that the other processes must drop too
+invalidation_listener = None
+
+def announce_invalidation(drop_fn, *args):
+    # drop_fn must be a module-level function, so that other processes can look it up by name
+    if invalidation_listener != None:
+        invalidation_listener(drop_fn, args)
+
+def invalidate(drop_fn, *args):
+    # Drop something cached from the DB now, and again once the current transaction is committed or discarded.
+    # Until then, this thread could cache uncommitted state, or another thread could cache the old state.
+    drop_fn(*args)
+    if 'invalidations' not in g:
+        g.invalidations = []
+    g.invalidations.append((drop_fn, args))
+    announce_invalidation(drop_fn, *args)
+
+def settle_invalidations():
+    for drop_fn, args in g.pop('invalidations', []):
+        drop_fn(*args)
 
 
 def get_from_dict(dict, *keys):
@@ -36,39 +80,175 @@ def fetchone_single(c):
     seq = c.fetchone()
     return seq[0] if seq else None
 
-def make_request(method, endpoint, json=None, headers=None, verbose=True, wait=False, **kwargs):
-    if verbose:
-        print('\n---BEGIN REQUEST')
-        print('Method: ' + method)
-        print('URL: ' + endpoint)
-        #if headers != None:
-        #    for key in headers:
-        #        print(f'{key}: {headers[key]}')
-        if json != None:
-            for key in json:
-                print(f'{key}: {json[key]}')
-        print('--- END  REQUEST')
+class TTLCache:
+    """
+    Bounded LRU cache whose entries expire after a TTL.
+    Negative entries (for lookups that found nothing) may use a shorter TTL.
+    """
+    def __init__(self, size, ttl, negative_ttl):
+        self._size = size
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def lookup(self, key):
+        # Returns (hit, value), since None is a valid cached value
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry == None:
+                return False, None
+
+            value, expiry = entry
+            if expiry <= monotonic():
+                del self._entries[key]
+                return False, None
+
+            self._entries.move_to_end(key)
+            return True, value
+
+    def put(self, key, value, negative=False):
+        expiry = monotonic() + (self._ttl if not negative else self._negative_ttl)
+        with self._lock:
+            self._entries[key] = (value, expiry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+_session = None
+_session_lock = Lock()
+
+def get_http_session():
+    # One keep-alive session shared by all threads, with a connection pool per host
+    global _session
+    if _session == None:
+        with _session_lock:
+            if _session == None:
+                session = Session()
+                adapter = HTTPAdapter(pool_connections=hs_pool_size, pool_maxsize=hs_pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+
+    return _session
+
+class CircuitOpenError(ConnectionError):
+    pass
+
+class CircuitBreaker:
+    """
+    Opens after a number of consecutive connection failures to a host, so that requests to it fail fast.
+    Once it has been open for a while, one request at a time is let through to try the host again.
+    """
+    def __init__(self, threshold, reset_timeout):
+        self._threshold = threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._lock = Lock()
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at == None:
+                return True
+            if monotonic() - self._opened_at >= self._reset_timeout:
+                # Restart the timeout, so that other requests keep failing fast while this one tries
+                self._opened_at = monotonic()
+                return True
+            return False
+
+    def is_open(self):
+        # Unlike allow, doesn't let a request through to try the host again
+        with self._lock:
+            return self._opened_at != None and monotonic() - self._opened_at < self._reset_timeout
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self._threshold:
+                self._opened_at = monotonic()
+
+_circuits = {}
+
+def get_circuit(url):
+    host = urlsplit(url).netloc
+    with _session_lock:
+        circuit = _circuits.get(host)
+        if circuit == None:
+            circuit = _circuits[host] = CircuitBreaker(hs_circuit_threshold, hs_circuit_reset)
+    return circuit
+
+def get_backoff(attempt):
+    # "Full jitter": a random delay of up to an exponentially growing limit
+    return uniform(0, min(hs_retry_max_delay, hs_retry_base_delay * 2**attempt))
+
+
+request_log = log.get('request')
 
+def make_request(method, endpoint, json=None, headers=None, verbose=True, wait=False, **kwargs):
+    # Connection failures are retried with backoff, up to a number of attempts (or forever with wait=True),
+    # and then raise a ConnectionError. While the host's circuit is open, requests raise CircuitOpenError
+    # right away, unless wait=True.
+    kwargs.setdefault('timeout', (hs_connect_timeout, hs_timeout))
+    # Requests made in the background aren't worth dumping unless tracing
+    level = logging.DEBUG if verbose else log.TRACE
+
+    if request_log.isEnabledFor(level):
+        request_log.log(level, 'request', extra=log.fields(method=method, url=endpoint, body=json))
+
+    template = metrics.endpoint_template(endpoint)
+    circuit = get_circuit(endpoint)
+    attempt = 0
     while True:
+        if not circuit.allow():
+            if not wait:
+                metrics.hs_rejected.inc(method, template)
+                raise CircuitOpenError(f'Circuit to {urlsplit(endpoint).netloc} is open')
+            sleep(get_backoff(attempt))
+            attempt += 1
+            continue
+
+        start = monotonic()
         try:
-            r = request(method, endpoint, json=json, headers=headers, **kwargs)
+            r = get_http_session().request(method, endpoint, json=json, headers=headers, **kwargs)
+            circuit.record_success()
             break
         except ConnectionError as e:
-            if verbose:
-                print('Error, try again in 5 seconds...')
-                sleep(5)
-
-    if verbose:
-        print('\n---BEGIN RESPONSE')
+            circuit.record_failure()
+            attempt += 1
+            if attempt >= hs_retry_attempts and not wait:
+                request_log.warning('connection error, giving up', extra=log.fields(
+                    method=method, url=endpoint, attempts=attempt, error=str(e)))
+                raise
+
+            delay = get_backoff(attempt)
+            metrics.hs_retries.inc(method, template)
+            request_log.warning('connection error, trying again', extra=log.fields(
+                method=method, url=endpoint, attempts=attempt, delay=round(delay, 3), error=str(e)))
+            sleep(delay)
+        except Timeout:
+            # The host is reachable but not answering in time, which shouldn't pin more threads
+            circuit.record_failure()
+            raise
+
+    metrics.hs_request_seconds.observe(monotonic() - start, method, template)
+    metrics.hs_responses.inc(method, template, r.status_code)
+
+    if request_log.isEnabledFor(level):
         try:
-            json = r.json()
-            for key in json:
-                print(f'{key}: {json[key]}')
-        except:
-            print(r.text)
-
-        print(f'STATUS: {r.status_code}')
-        #print(r.headers.items())
-        print('--- END  RESPONSE')
+            body = r.json()
+        except ValueError:
+            body = r.text
+        request_log.log(level, 'response', extra=log.fields(method=method, url=endpoint, status=r.status_code, body=body))
 
     return r
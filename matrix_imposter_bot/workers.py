@@ -0,0 +1,177 @@
+import multiprocessing
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
+from threading import Lock
+from zlib import crc32
+
+from . import app
+from . import config
+from . import log
+from . import outbox
+from . import utils
+
+# In multi-worker mode, the process serving requests splits each transaction by room,
+# and hands every shard of it to the worker process that owns those rooms.
+# A room always goes to the same worker, which handles one request at a time, so each room's events stay in order.
+#
+# Workers only handle events. The front process sends notices, receipts & presence, and runs the background jobs.
+# Caches that a worker drops are dropped by the other workers too, before the transaction is answered,
+# and by the front process, which also reads some of them.
+
+workers_log = log.get('server')
+
+
+def run_worker(conn):
+    # Leave shutting down to the front process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    log.setup()
+    outbox.send_here = False
+    from .main import handle_txn_events
+
+    invalidations = []
+    utils.invalidation_listener = lambda drop_fn, args: invalidations.append((drop_fn.__module__, drop_fn.__name__, args))
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+
+        kind = message[0]
+        if kind == 'stop':
+            return
+        elif kind == 'invalidate':
+            apply_invalidations(message[1])
+            conn.send(('ok',))
+        elif kind == 'events':
+            txnId, txn_events = message[1:]
+            invalidations.clear()
+            try:
+                with app.app_context():
+                    txn_success, seen_event_ids = handle_txn_events(txnId, txn_events)
+            except Exception:
+                # Still answer, so that the front process can fail the transaction
+                workers_log.exception('failed to handle events', extra=log.fields(txnId=txnId))
+                txn_success, seen_event_ids = False, {}
+
+            wake_outbox = outbox.wake_requested
+            outbox.wake_requested = False
+            conn.send(('done', txn_success, seen_event_ids, list(invalidations), wake_outbox))
+
+def apply_invalidations(invalidations):
+    for module_name, fn_name, args in invalidations:
+        getattr(import_module(module_name), fn_name)(*args)
+
+
+class Worker:
+    def __init__(self, index):
+        self.index = index
+        # Only one request to a worker at a time, and a room's events must not overtake each other
+        self._lock = Lock()
+        self._spawn()
+
+    def _spawn(self):
+        # Spawn instead of fork, since this process already has threads running
+        ctx = multiprocessing.get_context('spawn')
+        self._conn, child_conn = ctx.Pipe()
+        self._process = ctx.Process(target=run_worker, args=(child_conn,), name=f'worker-{self.index}', daemon=True)
+        self._process.start()
+        child_conn.close()
+
+    def call(self, *message):
+        # Returns None if the worker died, in which case it gets replaced
+        with self._lock:
+            try:
+                self._conn.send(message)
+                return self._conn.recv()
+            except (EOFError, OSError):
+                workers_log.error('worker died', extra=log.fields(worker=self.index))
+                self._conn.close()
+                self._process.join(1)
+                self._spawn()
+                return None
+
+    def stop(self):
+        with self._lock:
+            try:
+                self._conn.send(('stop',))
+            except OSError:
+                pass
+            self._process.join(5)
+
+
+pool = None
+executor = None
+
+
+def start():
+    global pool, executor
+    pool = [Worker(i) for i in range(config.workers)]
+    executor = ThreadPoolExecutor(max_workers=len(pool), thread_name_prefix='dispatch')
+    workers_log.info('started workers', extra=log.fields(workers=len(pool)))
+
+def stop():
+    if pool != None:
+        for worker in pool:
+            worker.stop()
+
+def get_shard(room_id):
+    # Must not change between runs, unlike hash()
+    return crc32(room_id.encode()) % len(pool) if room_id != None else 0
+
+def handle_txn_events(txnId, txn_events):
+    # Like main.handle_txn_events, but in the workers, returning once every shard is done
+    shards = {}
+    for i, event in txn_events:
+        shards.setdefault(get_shard(event.get('room_id')), []).append((i, event))
+
+    futures = [(index, executor.submit(pool[index].call, 'events', txnId, shard_events))
+        for index, shard_events in shards.items()]
+
+    txn_success = True
+    seen_event_ids = {}
+    wake_outbox = False
+    # Worker index -> invalidations it made
+    invalidations = {}
+    for index, future in futures:
+        result = future.result()
+        if result == None:
+            txn_success = False
+            continue
+
+        _, shard_success, shard_seen_event_ids, shard_invalidations, shard_wake_outbox = result
+        txn_success = shard_success and txn_success
+        seen_event_ids.update(shard_seen_event_ids)
+        wake_outbox = shard_wake_outbox or wake_outbox
+        if len(shard_invalidations) != 0:
+            invalidations[index] = shard_invalidations
+
+    if len(invalidations) != 0:
+        broadcast_invalidations(invalidations)
+        for shard_invalidations in invalidations.values():
+            apply_invalidations(shard_invalidations)
+    if wake_outbox:
+        outbox.wake()
+
+    return txn_success, seen_event_ids
+
+def invalidate_everywhere(drop_fn, *args):
+    # For the front process to have the workers drop something cached, after committing a change to it
+    run_everywhere(drop_fn, *args)
+
+def run_everywhere(fn, *args):
+    # For the front process to have the workers call a module-level function, like to update something they cached
+    if pool != None:
+        broadcast_invalidations({None: [(fn.__module__, fn.__name__, args)]})
+
+def broadcast_invalidations(invalidations):
+    # Worker index (or None for the front process) -> invalidations it made
+    futures = []
+    for worker in pool:
+        others = [invalidation for index, shard_invalidations in invalidations.items() if index != worker.index
+            for invalidation in shard_invalidations]
+        if len(others) != 0:
+            futures.append(executor.submit(worker.call, 'invalidate', others))
+    for future in futures:
+        future.result()